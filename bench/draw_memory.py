@@ -0,0 +1,76 @@
+"""قياس ذاكرة اختيار الفائزين مع أعداد مختلفة من المشاركين.
+
+يقارن reservoir_sample (المستخدم في draw_roulette) مع الطريقة القديمة
+(تحميل كل الصفوف ثم random.sample)، ويتحقق من عدالة الاختيار.
+
+    python bench/draw_memory.py
+    python bench/draw_memory.py --sizes 1000 100000 1000000 --winners 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import reservoir_sample  # noqa: E402
+
+
+async def participant_rows(count: int, batch: int = 1000):
+    """تدفق صفوف يشبه cursor قاعدة البيانات: دفعات صغيرة مع تسليم حلقة الأحداث بينها"""
+    for start in range(0, count, batch):
+        for user_id in range(start, min(start + batch, count)):
+            yield (user_id, f"user{user_id}", f"Participant {user_id}")
+        await asyncio.sleep(0)
+
+
+async def measure(coro_factory):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = await coro_factory()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+
+async def load_all_then_sample(count: int, k: int):
+    rows = [row async for row in participant_rows(count)]
+    return random.sample(rows, k)
+
+
+async def check_fairness(population: int, k: int, rounds: int) -> float:
+    """أكبر انحراف نسبي لعدد مرات فوز كل مشارك عن القيمة المتوقعة"""
+    wins = Counter()
+    for _ in range(rounds):
+        for row in await reservoir_sample(participant_rows(population, batch=population), k):
+            wins[row[0]] += 1
+    expected = rounds * k / population
+    return max(abs(wins[user_id] - expected) / expected for user_id in range(population))
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 500_000])
+    parser.add_argument('--winners', type=int, default=10)
+    parser.add_argument('--fairness-rounds', type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"{'participants':>12} | {'reservoir peak':>15} | {'time':>8} | {'load-all peak':>14} | {'time':>8}")
+    for size in args.sizes:
+        _, reservoir_peak, reservoir_time = await measure(lambda: reservoir_sample(participant_rows(size), args.winners))
+        _, naive_peak, naive_time = await measure(lambda: load_all_then_sample(size, args.winners))
+        print(f"{size:>12} | {reservoir_peak / 1024:>12.1f} KB | {reservoir_time:>7.2f}s "
+              f"| {naive_peak / 1024:>11.1f} KB | {naive_time:>7.2f}s")
+
+    deviation = await check_fairness(population=50, k=3, rounds=args.fairness_rounds)
+    print(f"\nfairness: 50 participants, 3 winners, {args.fairness_rounds} draws, "
+          f"max deviation from expected wins {deviation:.1%}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
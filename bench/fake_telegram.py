@@ -0,0 +1,147 @@
+"""خادم Bot API وهمي لاختبارات الحمل.
+
+يرد على الطرق التي يستخدمها البوت بنتائج صالحة لـ python-telegram-bot، ويحاكي
+حدود تليجرام (حد عام وحد لكل محادثة) بردود 429 مع retry_after، مع زمن شبكة اختياري.
+
+    python bench/fake_telegram.py --port 8081
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import TokenBucket, serve_http  # noqa: E402
+
+# الطرق التي تخضع لحدود الإرسال في تليجرام
+RATE_LIMITED_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument', 'sendInvoice'}
+
+BOT_USER = {
+    'id': 100000,
+    'is_bot': True,
+    'first_name': 'Roulette Panda',
+    'username': 'Roulette_Panda_Bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+
+class FakeTelegram:
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, group_rate: float = 20 / 60,
+                 latency: float = 0.02, member_status: str = 'member'):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.latency = latency
+        self.member_status = member_status
+        self.calls = Counter()
+        self.rejected = Counter()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._message_ids = 1000
+
+    def reset_counters(self) -> None:
+        self.calls.clear()
+        self.rejected.clear()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id > 0:
+                bucket = TokenBucket(self.private_rate, 3)
+            else:
+                bucket = TokenBucket(self.group_rate, 5)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _retry_after(self, method: str, chat_id) -> int:
+        """0 إذا كان الطلب مسموحًا، وإلا عدد الثواني التي يجب الانتظار"""
+        if method not in RATE_LIMITED_METHODS:
+            return 0
+        now = time.monotonic()
+        wait = self._global.try_take(now)
+        if not wait and chat_id is not None:
+            wait = self._chat_bucket(chat_id).try_take(now)
+        return math.ceil(wait) if wait else 0
+
+    def _message(self, chat_id: int, params: dict) -> dict:
+        self._message_ids += 1
+        message = {
+            'message_id': int(params.get('message_id') or self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        return message
+
+    def _result(self, method: str, params: dict, chat_id: int):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getChatMember':
+            return {
+                'status': self.member_status,
+                'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'User'},
+            }
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument', 'sendInvoice'):
+            return self._message(chat_id, params)
+        # answerCallbackQuery و setWebhook و deleteWebhook وغيرها
+        return True
+
+    async def handle(self, method, path, headers, body):
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        content_type = headers.get('content-type', '')
+        params = dict(parse_qsl(body.decode(), keep_blank_values=True)) if 'urlencoded' in content_type else {}
+        chat_id = params.get('chat_id')
+        chat_id = int(chat_id) if chat_id and chat_id.lstrip('-').isdigit() else None
+
+        retry_after = self._retry_after(api_method, chat_id)
+        if retry_after:
+            self.rejected[api_method] += 1
+            payload = {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after},
+            }
+            return 429, 'application/json', json.dumps(payload).encode()
+
+        payload = {'ok': True, 'result': self._result(api_method, params, chat_id if chat_id is not None else -1)}
+        return 200, 'application/json', json.dumps(payload).encode()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        server = await serve_http(host, port, self.handle)
+        self.port = server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{self.port}/bot'
+        return server
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated network latency in seconds')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency)
+    server = await fake.start(args.host, args.port)
+    print(f"Fake Bot API listening on {fake.base_url}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,316 @@
+"""اختبار حمل للمعالجات الحقيقية في bot.py.
+
+يشغل join_roulette و stop_participation و draw_roulette و show_main_menu بتحديثات
+مصطنعة عبر Application.process_update، مقابل خادم Bot API وهمي (bench/fake_telegram.py)
+وقاعدة Postgres مؤقتة، ثم يطبع الإنتاجية وزمن p50/p95/p99 وعدد استعلامات قاعدة
+البيانات واستدعاءات تليجرام لكل تحديث، ويقارنها بخط أساس محفوظ.
+
+    python bench/loadtest.py                          # Postgres مؤقت (يتطلب initdb و pg_ctl)
+    python bench/loadtest.py --database-url postgresql://localhost/bench
+    python bench/loadtest.py --save-baseline          # حفظ النتائج كخط أساس
+    python bench/loadtest.py --fail-on-regression     # رمز خروج 1 عند التراجع
+
+تحذير: الاختبار ينشئ جداول البوت ويكتب فيها، فلا تستخدم قاعدة بيانات الإنتاج.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+
+import bot  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+TOKEN = '123456:LOADTEST'
+CREATOR_ID = 900000001
+CHANNEL_ID = -1001000000001
+USER_ID_BASE = 1_000_000
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _pg_binary(name: str) -> str:
+    found = shutil.which(name)
+    if found:
+        return found
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        bindir = subprocess.run([pg_config, '--bindir'], capture_output=True, text=True, check=True).stdout.strip()
+        candidate = os.path.join(bindir, name)
+        if os.path.exists(candidate):
+            return candidate
+    raise SystemExit(f"{name} not found; install PostgreSQL or pass --database-url")
+
+
+@contextlib.contextmanager
+def throwaway_postgres():
+    """مجموعة Postgres مؤقتة على منفذ عشوائي تُحذف بعد الاختبار"""
+    workdir = tempfile.mkdtemp(prefix='roulette-bench-')
+    datadir = os.path.join(workdir, 'data')
+    port = _free_port()
+    pg_ctl = _pg_binary('pg_ctl')
+    try:
+        subprocess.run([_pg_binary('initdb'), '-D', datadir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                       check=True, capture_output=True)
+        subprocess.run([
+            pg_ctl, '-D', datadir, '-l', os.path.join(workdir, 'postgres.log'), '-w',
+            '-o', f"-p {port} -k {workdir} -c listen_addresses=127.0.0.1 -c fsync=off "
+                  f"-c synchronous_commit=off -c full_page_writes=off",
+            'start',
+        ], check=True, capture_output=True)
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run([pg_ctl, '-D', datadir, '-m', 'immediate', 'stop'], capture_output=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def callback_update(update_id: int, user_id: int, data: str, chat_id: int, message_id: int, text: str = '') -> dict:
+    chat_type = 'private' if chat_id > 0 else 'channel'
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'u{user_id}'},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': chat_type},
+                'text': text,
+                'reply_markup': {'inline_keyboard': [[{'text': 'join', 'callback_data': data}]]},
+            },
+        },
+    }
+
+
+async def seed_roulette(pool, participants: int = 0, active: bool = True, creator_id: int = CREATOR_ID) -> int:
+    roulette_id = await pool.fetchval("""
+        INSERT INTO roulettes (creator_id, message, winner_count, is_active, chat_id, message_id, channel_chat_id)
+        VALUES ($1, 'Load test roulette', 3, $2, $3, 1, $3)
+        RETURNING id
+    """, creator_id, active, CHANNEL_ID)
+    await bot.ensure_participant_partition(pool, roulette_id)
+    if participants:
+        await pool.execute("""
+            INSERT INTO participants (roulette_id, user_id, username, full_name)
+            SELECT $1, g, 'u' || g, 'User ' || g FROM generate_series($2::bigint, $3::bigint) g
+        """, roulette_id, USER_ID_BASE, USER_ID_BASE + participants - 1)
+        await pool.execute("UPDATE roulettes SET participant_count = $2 WHERE id = $1", roulette_id, participants)
+    return roulette_id
+
+
+async def seed(pool) -> None:
+    await pool.execute("""
+        INSERT INTO users (telegram_id, linked_channel_id, linked_channel_username) VALUES ($1, $2, 'loadtest')
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET linked_channel_id = EXCLUDED.linked_channel_id, linked_channel_username = EXCLUDED.linked_channel_username
+    """, CREATOR_ID, CHANNEL_ID)
+
+
+def disable_throttles() -> None:
+    """الحد من الضغطات يرد مبكرًا دون تشغيل المعالج، فيُعطل حتى تقيس النتائج المعالجات نفسها"""
+    bot.user_throttle = bot.CallbackThrottle(1e9, 1e9, bot.THROTTLE_MAX_KEYS)
+    bot.roulette_throttle = bot.CallbackThrottle(1e9, 1e9, bot.THROTTLE_MAX_KEYS)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(application, fake: FakeTelegram, name: str, updates: list, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(data):
+        async with semaphore:
+            update = Update.de_json(data, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.sleep(0)
+    queries_before = bot.DB_QUERY_LATENCY.total_count()
+    fake.reset_counters()
+    started = time.perf_counter()
+    await asyncio.gather(*(process(data) for data in updates))
+    elapsed = time.perf_counter() - started
+    # سجلات الاستعلامات تُسجل عبر call_soon بعد كل استعلام
+    await asyncio.sleep(0)
+    queries = bot.DB_QUERY_LATENCY.total_count() - queries_before
+
+    latencies.sort()
+    count = len(updates)
+    return {
+        'scenario': name,
+        'updates': count,
+        'seconds': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'db_round_trips_per_update': round(queries / count, 2),
+        'api_calls_per_update': round(sum(fake.calls.values()) / count, 2),
+        'api_429': sum(fake.rejected.values()),
+    }
+
+
+async def run(args) -> list:
+    fake = FakeTelegram(latency=args.api_latency)
+    fake_server = await fake.start()
+
+    with contextlib.ExitStack() as stack:
+        database_url = args.database_url or stack.enter_context(throwaway_postgres())
+        pool = await bot.init_db(database_url)
+        if not pool:
+            raise SystemExit("could not initialise the database")
+
+        if not args.throttle:
+            disable_throttles()
+        application = bot.build_application(TOKEN, pool, base_url=fake.base_url)
+        await application.initialize()
+        bot.notification_sender.start(application.bot)
+        results = []
+        try:
+            await seed(pool)
+            update_id = 0
+
+            # المشاركة: كل مستخدم يضغط مرة، مع نسبة ضغطات مكررة
+            join_id = await seed_roulette(pool)
+            updates = []
+            for i in range(args.joins):
+                user_id = USER_ID_BASE + i
+                for _ in range(2 if i % 10 == 0 else 1):
+                    update_id += 1
+                    updates.append(callback_update(update_id, user_id, f'join_{join_id}', CHANNEL_ID, 1))
+            results.append(await run_scenario(application, fake, 'join_roulette', updates, args.concurrency))
+
+            # القائمة الرئيسية من محادثات خاصة
+            updates = []
+            for i in range(args.menus):
+                update_id += 1
+                user_id = USER_ID_BASE + i
+                updates.append(callback_update(update_id, user_id, 'back_to_main', user_id, 1))
+            results.append(await run_scenario(application, fake, 'show_main_menu', updates, args.concurrency))
+
+            # إيقاف المشاركة في سحوبات مختلفة، كل سحب لمنشئ مختلف
+            updates = []
+            for i in range(args.stops):
+                update_id += 1
+                creator_id = CREATOR_ID + 1 + i
+                roulette_id = await seed_roulette(pool, creator_id=creator_id)
+                updates.append(callback_update(update_id, creator_id, f'stop_{roulette_id}', creator_id, 1))
+            results.append(await run_scenario(application, fake, 'stop_participation', updates, args.concurrency))
+
+            # السحب على سحوبات متوقفة بها مشاركون
+            updates = []
+            for i in range(args.draws):
+                update_id += 1
+                creator_id = CREATOR_ID + 1 + args.stops + i
+                roulette_id = await seed_roulette(pool, participants=args.draw_participants, active=False,
+                                                  creator_id=creator_id)
+                updates.append(callback_update(update_id, creator_id, f'draw_{roulette_id}', creator_id, 1))
+            results.append(await run_scenario(application, fake, 'draw_roulette', updates, args.concurrency))
+        finally:
+            await bot.notification_sender.stop()
+            await application.shutdown()
+            await pool.close()
+            fake_server.close()
+    return results
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """مقارنة النتائج بخط الأساس؛ تعيد قائمة التراجعات"""
+    regressions = []
+    print(f"\n{'scenario':<20} {'throughput':>18} {'p95 ms':>18} {'db/update':>16}")
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if not base:
+            continue
+
+        def change(key):
+            return (result[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+
+        print(f"{result['scenario']:<20} {result['throughput']:>9} ({change('throughput'):+6.1f}%) "
+              f"{result['p95_ms']:>9} ({change('p95_ms'):+6.1f}%) "
+              f"{result['db_round_trips_per_update']:>7} ({base['db_round_trips_per_update']})")
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: throughput {result['throughput']} < {base['throughput']}")
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{result['scenario']}: p95 {result['p95_ms']}ms > {base['p95_ms']}ms")
+        if result['db_round_trips_per_update'] > base['db_round_trips_per_update'] + 0.05:
+            regressions.append(f"{result['scenario']}: db round trips {result['db_round_trips_per_update']} "
+                               f"> {base['db_round_trips_per_update']}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help='use an existing (disposable) database instead of a throwaway cluster')
+    parser.add_argument('--joins', type=int, default=2000)
+    parser.add_argument('--menus', type=int, default=500)
+    parser.add_argument('--stops', type=int, default=50)
+    parser.add_argument('--draws', type=int, default=10)
+    parser.add_argument('--draw-participants', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--throttle', action='store_true',
+                        help='keep the callback throttles on (by default they are disabled so handlers are measured)')
+    parser.add_argument('--api-latency', type=float, default=0.02, help='simulated Bot API latency in seconds')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (0.2 = 20%%)')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        columns = ['scenario', 'updates', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms',
+                   'db_round_trips_per_update', 'api_calls_per_update', 'api_429']
+        print(" | ".join(columns))
+        for result in results:
+            print(" | ".join(str(result[column]) for column in columns))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({result['scenario']: result for result in results}, f, indent=2)
+        print(f"\nbaseline saved to {args.baseline}")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
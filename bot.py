@@ -3,7 +3,12 @@ from dotenv import load_dotenv
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
+# إشارة الإيقاف التي يضعها Application.stop في الطابور (نحتاجها لأننا نستبدل _update_fetcher)
+from telegram.ext._application import _STOP_SIGNAL
 from telegram.ext import (
+    BaseRateLimiter,
     Application,
     CommandHandler,
     CallbackQueryHandler,
@@ -13,13 +18,31 @@ from telegram.ext import (
     ConversationHandler,
     filters
 )
+import csv
+import gzip
+import io
+import heapq
+import itertools
+import hmac
+import html
+import json
+import re
+import math
 import random
+import secrets
+import tempfile
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-import re
 import asyncpg
 import asyncio
+import bisect
+import sys
+from array import array
+import contextlib
+import functools
 import platform
-import httpx
+from http import HTTPStatus
 
 # تحميل متغيرات البيئة
 load_dotenv()
@@ -31,6 +54,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
 # بيانات البوت من متغيرات البيئة
 
 CHANNEL = f"@{os.getenv('CHANNEL_USERNAME')}" if os.getenv('CHANNEL_USERNAME') else None
@@ -51,15 +82,127 @@ PRICES = {
 
 STARS_CURRENCY = "XTR"
 
-async def verify_token(token: str) -> bool:
-    """تحقق من صحة التوكن مع سيرفر تليجرام"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"https://api.telegram.org/bot{token}/getMe")
-            return response.status_code == 200
-    except Exception as e:
-        logger.error(f"فشل التحقق من التوكن: {e}")
-        return False
+# أقل فترة (بالثواني) بين تعديلين لمنشور نفس السحب
+EDIT_COALESCE_INTERVAL = env_float('EDIT_COALESCE_INTERVAL', 3.0)
+
+# كاش التحقق من الاشتراك في القنوات
+MEMBERSHIP_CACHE_SIZE = env_int('MEMBERSHIP_CACHE_SIZE', 50000)
+MEMBERSHIP_POSITIVE_TTL = env_float('MEMBERSHIP_POSITIVE_TTL', 300.0)
+MEMBERSHIP_NEGATIVE_TTL = env_float('MEMBERSHIP_NEGATIVE_TTL', 10.0)
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# عدد الصفوف التي تُجلب في كل دفعة أثناء السحب
+DRAW_FETCH_SIZE = env_int('DRAW_FETCH_SIZE', 1000)
+
+# إرسال الرسائل الجماعية في الخلفية؛ السرعة يحددها محدد الطلبات المشترك
+NOTIFY_WORKERS = env_int('NOTIFY_WORKERS', 8)
+NOTIFY_QUEUE_SIZE = env_int('NOTIFY_QUEUE_SIZE', 10000)
+
+# محدد طلبات Bot API المشترك (حد تليجرام ~30 رسالة/ثانية عمومًا، ~1/ثانية لكل محادثة خاصة، 20/دقيقة للمجموعات والقنوات)
+TELEGRAM_GLOBAL_RATE = env_float('TELEGRAM_GLOBAL_RATE', 25.0)
+TELEGRAM_PRIVATE_CHAT_RATE = env_float('TELEGRAM_PRIVATE_CHAT_RATE', 1.0)
+TELEGRAM_GROUP_CHAT_RATE = env_float('TELEGRAM_GROUP_CHAT_RATE', 20 / 60)
+TELEGRAM_CHAT_BURST = env_float('TELEGRAM_CHAT_BURST', 3.0)
+# نسبة من الحد العام لا تستخدمها الرسائل الجماعية، فتبقى متاحة لردود المستخدمين
+TELEGRAM_BULK_RESERVE = env_float('TELEGRAM_BULK_RESERVE', 0.2)
+TELEGRAM_MAX_RETRIES = env_int('TELEGRAM_MAX_RETRIES', 3)
+# ردود 429 بانتظار أطول من هذا تُعاد للمستدعي بدل الانتظار
+TELEGRAM_MAX_RETRY_WAIT = env_float('TELEGRAM_MAX_RETRY_WAIT', 60.0)
+TELEGRAM_RETRY_JITTER = 0.2
+TELEGRAM_CONNECTION_POOL_SIZE = env_int('TELEGRAM_CONNECTION_POOL_SIZE', 256)
+
+# عدد المشاركين في كل صفحة من قائمة المشاركين (يبقي الرسالة أقل من 4096 حرفًا)
+PARTICIPANTS_PAGE_SIZE = env_int('PARTICIPANTS_PAGE_SIZE', 25)
+
+# كاش بيانات المستخدمين (الرصيد والاشتراك والقناة المربوطة)
+USER_CACHE_SIZE = env_int('USER_CACHE_SIZE', 20000)
+USER_CACHE_TTL = env_float('USER_CACHE_TTL', 60.0)
+
+# سجل السحوبات في الذاكرة لمسار المشاركة (يُبطل محليًا عند كل تغيير؛ المدة تحمي من تغييرات نسخ أخرى)
+ROULETTE_CACHE_SIZE = env_int('ROULETTE_CACHE_SIZE', 10000)
+ROULETTE_CACHE_TTL = env_float('ROULETTE_CACHE_TTL', 30.0)
+
+# أرقام المشاركين في السحوبات النشطة لرفض المشاركة المكررة دون اتصال؛ 8 بايت لكل مشارك
+PARTICIPANT_FILTER_MAX_IDS = env_int('PARTICIPANT_FILTER_MAX_IDS', 4_000_000)
+PARTICIPANT_FILTER_MAX_ROULETTES = env_int('PARTICIPANT_FILTER_MAX_ROULETTES', 500)
+# المشاركات الجديدة تُجمع في set صغير ثم تُحفظ كمصفوفة مرتبة عند هذا العدد
+PARTICIPANT_FILTER_MERGE_SIZE = 1024
+# أقصى حجم لمصفوفة المشاركات الجديدة المدمجة (يحدد أطول توقف للدمج)
+PARTICIPANT_FILTER_RUN_SIZE = 65536
+
+# عدد عمليات تصدير المشاركين التي تعمل في نفس الوقت
+EXPORT_CONCURRENCY = env_int('EXPORT_CONCURRENCY', 2)
+# أقصى حجم ملف يقبله تليجرام من البوتات
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+# طريقة استقبال التحديثات: polling (الافتراضي) أو webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = env_int('WEBHOOK_PORT', env_int('PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# العنوان العام الذي يرسل إليه تليجرام؛ بدونه لا يُسجل الـ webhook (مفيد للتجربة محليًا)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# كل طلب يجب أن يحمل هذا الرمز؛ مع WEBHOOK_URL وبدونه يُولد رمز لكل تشغيل ويُسلم لتليجرام
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 75
+
+# نقطة المقاييس بصيغة Prometheus (METRICS_PORT=0 لتعطيلها)
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = env_int('METRICS_PORT', 9464)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# مهمة انتهاء الاشتراكات: كل كم ثانية تعمل، ومتى يُذكّر المستخدم قبل الانتهاء (0 لتعطيل التذكير)
+PREMIUM_SWEEP_INTERVAL = env_float('PREMIUM_SWEEP_INTERVAL', 300.0)
+PREMIUM_REMINDER_HOURS = env_float('PREMIUM_REMINDER_HOURS', 24.0)
+PREMIUM_REMINDER_BATCH = env_int('PREMIUM_REMINDER_BATCH', 500)
+
+# إعدادات مجمع اتصالات قاعدة البيانات؛ حد أدنى صغير يعني اتصالات أقل عند التشغيل
+DB_POOL_MIN_SIZE = env_int('DB_POOL_MIN_SIZE', 2)
+DB_POOL_MAX_SIZE = env_int('DB_POOL_MAX_SIZE', 20)
+DB_STATEMENT_CACHE_SIZE = env_int('DB_STATEMENT_CACHE_SIZE', 256)
+DB_MAX_INACTIVE_LIFETIME = env_float('DB_MAX_INACTIVE_LIFETIME', 300.0)
+DB_COMMAND_TIMEOUT = env_float('DB_COMMAND_TIMEOUT', 30.0)
+# إعدادات الجلسة تُرسل مع طلب الاتصال نفسه فلا تكلف استعلامًا إضافيًا لكل اتصال
+DB_SERVER_SETTINGS = {
+    'application_name': os.getenv('DB_APPLICATION_NAME', 'roulette_panda_bot'),
+    'statement_timeout': str(env_int('DB_STATEMENT_TIMEOUT_MS', 30000)),
+    'idle_in_transaction_session_timeout': str(env_int('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', 60000)),
+}
+# الترحيلات والتصدير قد تستغرق دقائق على قاعدة كبيرة، فتعمل على اتصال مستقل بلا مهلة
+UNBOUNDED_SERVER_SETTINGS = {**DB_SERVER_SETTINGS, 'statement_timeout': '0'}
+
+# عدد التحديثات التي تُعالج في نفس الوقت؛ تحديثات نفس المستخدم أو نفس السحب تبقى متتابعة
+UPDATE_CONCURRENCY = env_int('UPDATE_CONCURRENCY', 64)
+# أقصى عدد تحديثات معلقة (تنتظر قفلها أو مكانًا للمعالجة)؛ عنده يتوقف سحب التحديثات من الطابور،
+# والطابور نفسه محدود بنفس العدد فيتوقف polling ويرد webhook بـ 503 حتى يعيد تليجرام المحاولة
+UPDATE_MAX_PENDING = env_int('UPDATE_MAX_PENDING', 10000)
+
+# تحديد معدل ضغطات أزرار السحب لكل مستخدم ولكل سحب قبل أي استعلام
+THROTTLE_USER_RATE = env_float('THROTTLE_USER_RATE', 1.0)
+THROTTLE_USER_BURST = env_float('THROTTLE_USER_BURST', 3.0)
+THROTTLE_ROULETTE_RATE = env_float('THROTTLE_ROULETTE_RATE', 200.0)
+THROTTLE_ROULETTE_BURST = env_float('THROTTLE_ROULETTE_BURST', 400.0)
+THROTTLE_MAX_KEYS = env_int('THROTTLE_MAX_KEYS', 100000)
+
+# أرشفة مشاركي السحوبات المنتهية منذ أكثر من ARCHIVE_AFTER_DAYS يومًا، والسحوبات الموقوفة أو
+# المهجورة (دون سحب) التي لم يشارك فيها أحد منذ ARCHIVE_IDLE_DAYS يومًا
+ARCHIVE_AFTER_DAYS = env_int('ARCHIVE_AFTER_DAYS', 30)
+ARCHIVE_IDLE_DAYS = env_int('ARCHIVE_IDLE_DAYS', 90)
+ARCHIVE_INTERVAL = env_float('ARCHIVE_INTERVAL', 3600.0)
+ARCHIVE_BATCH = env_int('ARCHIVE_BATCH', 50)
+
+# خيارات الإغلاق والسحب التلقائي عند إنشاء السحب
+AUTO_CLOSE_HOURS = (1, 6, 24, 72)
+AUTO_CLOSE_CAPS = (50, 100, 500, 1000)
+# عدد السحوبات المستحقة التي تُغلق وتُسحب في نفس الوقت، والانتظار قبل إعادة المحاولة بعد خطأ
+SCHEDULER_CONCURRENCY = env_int('SCHEDULER_CONCURRENCY', 4)
+SCHEDULER_RETRY_DELAY = env_float('SCHEDULER_RETRY_DELAY', 60.0)
+
+# إضافة النقاط دفعة واحدة من رسالة متعددة الأسطر أو ملف CSV
+BULK_POINTS_MAX_ROWS = env_int('BULK_POINTS_MAX_ROWS', 100000)
+BULK_POINTS_MAX_FILE_SIZE = 5 * 1024 * 1024
+POINTS_LIMIT = 2 ** 31 - 1
 
 async def safe_answer_query(query, text=None, show_alert=False):
     """دالة مساعدة للرد الآمن على الاستعلامات مع معالجة الأخطاء"""
@@ -80,148 +223,1487 @@ async def safe_answer_query(query, text=None, show_alert=False):
             logger.error(f"فشل إرسال الرسالة البديلة: {e2}")
             return False
 
-async def init_db():
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+class Histogram:
+    """مدرج تكراري بحدود ثابتة؛ التسجيل عملية bisect وزيادة عداد فقط"""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def total_count(self) -> int:
+        return sum(sum(counts) for counts, _ in self._series.values())
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            cumulative += counts[-1]
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._callbacks = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_callback(self, name: str, documentation: str, metric_type: str, labelnames, collect) -> None:
+        """مقياس تُقرأ قيمه عند الطلب فقط: collect() تعيد [(قيم العناوين، القيمة)]"""
+        self._callbacks.append((name, documentation, metric_type, tuple(labelnames), collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        for name, documentation, metric_type, labelnames, collect in self._callbacks:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram('bot_handler_duration_seconds', 'Update handler latency', ['handler'])
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Update handlers that raised', ['handler'])
+DB_QUERY_LATENCY = metrics.histogram('bot_db_query_duration_seconds', 'Database query latency', ['query'])
+DB_QUERY_ERRORS = metrics.counter('bot_db_query_errors_total', 'Database queries that failed', ['query'])
+DB_POOL_WAIT = metrics.histogram('bot_db_pool_wait_seconds', 'Time spent waiting in pool.acquire()')
+TELEGRAM_LATENCY = metrics.histogram('bot_telegram_request_duration_seconds', 'Telegram Bot API request latency', ['method'])
+TELEGRAM_ERRORS = metrics.counter('bot_telegram_errors_total', 'Telegram Bot API requests that failed', ['method'])
+TELEGRAM_RETRY_AFTER = metrics.counter('bot_telegram_retry_after_total', 'Telegram Bot API flood-limit (429) responses', ['method'])
+CALLBACKS_THROTTLED = metrics.counter('bot_callbacks_throttled_total', 'Callback taps rejected by the throttle', ['handler', 'scope'])
+TELEGRAM_LIMITER_WAIT = metrics.histogram('bot_telegram_limiter_wait_seconds', 'Time requests waited in the outbound rate limiter', ['priority'])
+TELEGRAM_RETRIES = metrics.counter('bot_telegram_retries_total', 'Telegram Bot API requests retried after a flood-limit response', ['method'])
+JOB_ROWS = metrics.counter('bot_job_rows_total', 'Rows processed by background jobs', ['job', 'action'])
+
+def instrumented(handler):
+    """تسجيل زمن تنفيذ المعالج وأخطائه باسم الدالة"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+_QUERY_TABLE = re.compile(r'\b(?:from|into|update|join)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+_query_labels = {}
+
+def query_label(sql: str) -> str:
+    """اسم قصير وثابت للاستعلام (الفعل والجدول الأول) حتى لا تتضخم عناوين المقاييس"""
+    label = _query_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        verb = words[0].lower() if words else ''
+        table = _QUERY_TABLE.search(sql)
+        label = f"{verb} {table.group(1).lower()}" if table else verb
+        if len(_query_labels) < 1000:
+            _query_labels[sql] = label
+    return label
+
+def record_query(record) -> None:
+    label = query_label(record.query)
+    DB_QUERY_LATENCY.observe(record.elapsed, label)
+    if record.exception is not None:
+        DB_QUERY_ERRORS.inc(label)
+
+class _TimedAcquire:
+    __slots__ = ('_context',)
+
+    def __init__(self, context):
+        self._context = context
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        conn = await self._context.__aenter__()
+        DB_POOL_WAIT.observe(time.perf_counter() - started)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._context.__aexit__(*exc)
+
+class InstrumentedPool:
+    """غلاف حول asyncpg.Pool يقيس زمن انتظار الاتصال لكل الاستعلامات"""
+
+    def __init__(self, pool, database_url: str):
+        self._pool = pool
+        self.database_url = database_url
+
+    def acquire(self, *, timeout=None):
+        return _TimedAcquire(self._pool.acquire(timeout=timeout))
+
+    @contextlib.asynccontextmanager
+    async def unbounded_connection(self):
+        """اتصال مستقل خارج المجمع بدون command_timeout ولا statement_timeout، للأعمال الطويلة
+        (الترحيلات ونسخ COPY في التصدير) التي تتجاوز مهلة اتصالات المجمع"""
+        conn = await asyncpg.connect(self.database_url, server_settings=UNBOUNDED_SERVER_SETTINGS)
+        try:
+            await setup_connection(conn)
+            yield conn
+        finally:
+            await conn.close()
+
+    async def execute(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, **kwargs)
+
+    async def executemany(self, query, args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.executemany(query, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetch(query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+class InstrumentedRequest(HTTPXRequest):
+    """طلبات Bot API مع تسجيل الزمن والأخطاء وردود 429 لكل method"""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            TELEGRAM_ERRORS.inc(endpoint)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, endpoint)
+        if code == 429:
+            TELEGRAM_RETRY_AFTER.inc(endpoint)
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(endpoint)
+        return code, payload
+
+def channel_label(username, title) -> str:
+    """اسم القناة كما يظهر في المنشورات (HTML): @username إن وجد وإلا العنوان"""
+    if username:
+        return f"@{username}"
+    return html.escape(title) if title else None
+
+def render_roulette_post(roulette_text: str, condition_channel, participant_count: int) -> str:
+    """بناء نص منشور السحب من الكليشة المخزنة وعدد المشاركين"""
+    message_text = f"{roulette_text}\n\n"
+    if condition_channel:
+        message_text += f"⚡ شرط السحب: الاشتراك في {condition_channel}\n\n"
+    message_text += f"عدد المشاركين: {participant_count}\n\nروليت باندا @Roulette_Panda_Bot"
+    return message_text
+
+def roulette_post_markup(roulette_id: int, is_active: bool) -> InlineKeyboardMarkup:
+    """أزرار منشور السحب حسب حالة المشاركة"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("المشاركة في السحب", callback_data=f'join_{roulette_id}')],
+        [
+            InlineKeyboardButton("🎲 ابدأ السحب", callback_data=f'draw_{roulette_id}'),
+            InlineKeyboardButton("⏸ إيقاف المشاركة" if is_active else "⏹ استأناف المشاركة", 
+                               callback_data=f'stop_{roulette_id}')
+        ],
+        [InlineKeyboardButton("🔔 ذكرني إذا فزت 💌", callback_data='remind_me')]
+    ])
+
+class RouletteEditCoalescer:
+    """تجميع تحديثات عدد المشاركين: تعديل واحد على الأكثر لكل سحب خلال كل فترة،
+    وآخر تعديل يحمل دائمًا أحدث عدد"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._states = {}
+        self._tasks = {}
+
+    def schedule(self, bot, roulette_id: int, chat_id: int, message_id: int,
+                 roulette_text: str, condition_channel, count: int, reply_markup=None) -> None:
+        state = self._states.get(roulette_id)
+        if state is None:
+            state = self._states[roulette_id] = {
+                'count': count,
+                'flushed_count': None,
+                'last_flush': 0.0,
+                'failures': 0,
+            }
+        # الانضمامات المتزامنة قد تصل بترتيب مختلف، والعدد لا ينقص أبدًا
+        state['count'] = max(state['count'], count)
+        state.update(
+            chat_id=chat_id,
+            message_id=message_id,
+            roulette_text=roulette_text,
+            condition_channel=condition_channel,
+            reply_markup=reply_markup,
+        )
+
+        if roulette_id not in self._tasks:
+            self._tasks[roulette_id] = asyncio.create_task(self._flush_loop(bot, roulette_id))
+
+    def set_markup(self, roulette_id: int, reply_markup) -> None:
+        """تحديث الأزرار المعلقة حتى لا يعيد التعديل القادم أزرارًا قديمة"""
+        state = self._states.get(roulette_id)
+        if state is not None:
+            state['reply_markup'] = reply_markup
+
+    def forget(self, roulette_id: int) -> None:
+        task = self._tasks.pop(roulette_id, None)
+        if task is not None:
+            task.cancel()
+        self._states.pop(roulette_id, None)
+
+    async def _flush_loop(self, bot, roulette_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                state = self._states[roulette_id]
+                delay = state['last_flush'] + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                count = state['count']
+                if count == state['flushed_count']:
+                    # لا جديد خلال فترة كاملة بعد آخر تعديل
+                    del self._states[roulette_id]
+                    return
+
+                try:
+                    await bot.edit_message_text(
+                        chat_id=state['chat_id'],
+                        message_id=state['message_id'],
+                        text=render_roulette_post(state['roulette_text'], state['condition_channel'], count),
+                        reply_markup=state['reply_markup'],
+                        parse_mode=ParseMode.HTML
+                    )
+                    state['flushed_count'] = count
+                    state['failures'] = 0
+                except RetryAfter as e:
+                    logger.warning(f"Flood limit while updating roulette {roulette_id}, retrying in {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except BadRequest as e:
+                    if "Message is not modified" not in str(e):
+                        logger.error(f"Error updating roulette message: {e}")
+                        del self._states[roulette_id]
+                        return
+                    state['flushed_count'] = count
+                except Exception as e:
+                    logger.error(f"Error updating roulette message: {e}")
+                    state['failures'] += 1
+                    if state['failures'] >= 3:
+                        del self._states[roulette_id]
+                        return
+
+                state['last_flush'] = loop.time()
+        finally:
+            if self._tasks.get(roulette_id) is asyncio.current_task():
+                del self._tasks[roulette_id]
+
+edit_coalescer = RouletteEditCoalescer(EDIT_COALESCE_INTERVAL)
+
+# مولد عشوائي آمن تشفيريًا لاختيار الفائزين
+secure_random = random.SystemRandom()
+
+def _open_unit(rng) -> float:
+    """رقم عشوائي في المجال المفتوح (0, 1)"""
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+async def reservoir_sample(rows, k: int, rng=secure_random) -> list:
+    """اختيار k عناصر بالتساوي من تدفق غير معروف الطول دون تحميله كاملًا في الذاكرة.
+
+    تستخدم طريقة القفز (Algorithm L) فيحتاج المولد الآمن إلى O(k·log(n/k)) رقمًا
+    عشوائيًا فقط بدل رقم لكل صف.
+    """
+    reservoir = []
+    if k <= 0:
+        return reservoir
+
+    w = math.exp(math.log(_open_unit(rng)) / k)
+    next_index = k
+    index = 0
+    async for row in rows:
+        if index < k:
+            reservoir.append(row)
+            if index == k - 1:
+                next_index += math.floor(math.log(_open_unit(rng)) / math.log(1 - w)) if w < 1 else 0
+        elif index == next_index:
+            reservoir[rng.randrange(k)] = row
+            w *= math.exp(math.log(_open_unit(rng)) / k)
+            next_index += (math.floor(math.log(_open_unit(rng)) / math.log(1 - w)) if w < 1 else 0) + 1
+        index += 1
+    # ترتيب الخزان يتبع ترتيب القراءة جزئيًا، لذلك نخلطه قبل إعلان الفائزين
+    rng.shuffle(reservoir)
+    return reservoir
+
+class LookupAbandoned(Exception):
+    """المهمة التي كانت تنفذ طلبًا مشتركًا (single-flight) أُلغيت قبل أن تكمله؛ المنتظرون
+    يعيدون الطلب بأنفسهم بدل أن يصلهم إلغاء ليس لهم"""
+
+class MembershipCache:
+    """كاش محدود الحجم (LRU) لنتائج get_chat_member بمفتاح (القناة، المستخدم)،
+    مع مدة صلاحية منفصلة للنتائج الإيجابية والسلبية ودمج الطلبات المتزامنة"""
+
+    def __init__(self, max_size: int, positive_ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    @staticmethod
+    def _key(chat_id, user_id: int):
+        if isinstance(chat_id, str):
+            chat_id = chat_id.lower()
+        return chat_id, user_id
+
+    async def is_member(self, bot, chat_id, user_id: int, trust_negative: bool = True) -> bool:
+        key = self._key(chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            is_member, expires_at = entry
+            if expires_at > time.monotonic() and (is_member or trust_negative):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return is_member
+            del self._entries[key]
+
+        # طلب مماثل قيد التنفيذ: ننتظر نتيجته بدل استدعاء تليجرام مرة أخرى
+        future = self._inflight.get(key)
+        if future is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except LookupAbandoned:
+                return await self.is_member(bot, chat_id, user_id, trust_negative)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+            is_member = member.status in MEMBER_STATUSES
+        except asyncio.CancelledError:
+            future.set_exception(LookupAbandoned())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # الخطأ يُعاد لمن ينتظر فقط، ولا نريد تحذير "exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(is_member)
+            self._store(key, is_member)
+            return is_member
+        finally:
+            del self._inflight[key]
+
+    def _store(self, key, is_member: bool) -> None:
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_POSITIVE_TTL, MEMBERSHIP_NEGATIVE_TTL)
+
+class TokenBucket:
+    """دلو رموز بسيط: rate رمز في الثانية وسعة قصوى capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now: float = None, reserve: float = 0.0) -> float:
+        """يأخذ رمزًا ويعيد 0، أو يعيد عدد الثواني حتى يتوفر رمز.
+        reserve: عدد رموز تبقى في الدلو لا يأخذها هذا الطلب"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return 0.0
+        return (1 + reserve - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """لا رموز خلال seconds ثانية (بعد رد 429 من تليجرام)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def take(self) -> None:
+        while True:
+            delay = self.try_take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+class CallbackThrottle:
+    """دلو رموز لكل مفتاح في LRU محدود الحجم.
+
+    الدلو الذي لم يُستخدم لمدة capacity / rate امتلأ من جديد، فحذفه لا يغير النتيجة؛
+    لذلك تُحذف الدلاء الخاملة من بداية الـ LRU عند كل فحص.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_keys: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.idle_after = capacity / rate
+        self._buckets = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key) -> bool:
+        return not self.bucket(key).try_take()
+
+    def bucket(self, key) -> TokenBucket:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        else:
+            self._buckets.move_to_end(key)
+
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        idle_since = now - self.idle_after
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if oldest.updated > idle_since or oldest is bucket:
+                break
+            buckets.popitem(last=False)
+        return bucket
+
+user_throttle = CallbackThrottle(THROTTLE_USER_RATE, THROTTLE_USER_BURST, THROTTLE_MAX_KEYS)
+roulette_throttle = CallbackThrottle(THROTTLE_ROULETTE_RATE, THROTTLE_ROULETTE_BURST, THROTTLE_MAX_KEYS)
+
+_THROTTLED_CALLBACK = re.compile(r'^(join|draw|stop)_(\d+)$')
+THROTTLED_HANDLERS = {'join': 'join_roulette', 'draw': 'draw_roulette', 'stop': 'stop_participation'}
+
+async def reject_throttled(update) -> bool:
+    """رفض الضغطات الزائدة على أزرار السحب (join_/draw_/stop_) برد فوري قبل انتظار أي قفل أو استعلام"""
+    query = update.callback_query if isinstance(update, Update) else None
+    if query is None or not query.data:
+        return False
+    match = _THROTTLED_CALLBACK.match(query.data)
+    if not match:
+        return False
+    if not user_throttle.allow(query.from_user.id):
+        scope = 'user'
+    elif match.group(1) == 'join' and not roulette_throttle.allow(match.group(2)):
+        # حد السحب للمشاركات فقط، حتى لا تستهلكه موجة مشاركات فتُرفض أزرار المنشئ التي توقفها
+        scope = 'roulette'
+    else:
+        return False
+    CALLBACKS_THROTTLED.inc(THROTTLED_HANDLERS[match.group(1)], scope)
+    await safe_answer_query(query, "⏳ ضغطات كثيرة، حاول بعد لحظات.")
+    return True
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+# rate_limit_args للرسائل الجماعية والتنبيهات
+BULK = {'priority': PRIORITY_BULK}
+
+# الطرق التي تُحسب ضمن حدود الإرسال؛ answerCallbackQuery و getChatMember وغيرها لا تنتظر
+RATE_LIMITED_PREFIXES = ('send', 'edit', 'copyMessage', 'forwardMessage')
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """محدد مشترك لكل طلبات Bot API: حد عام للرسائل في الثانية، وحد لكل محادثة، ومساران للأولوية.
+
+    الطلبات العادية (ردود المستخدمين ومنشورات السحوبات) تستخدم كل الحد العام. طلبات
+    rate_limit_args=BULK تترك جزءًا منه وتنتظر ما دام هناك طلب عادي ينتظر. عند RetryAfter
+    تُوقف المحادثة (أو الحد العام) مدة الانتظار مع تشويش عشوائي ثم يُعاد الطلب.
+
+    إيقاف المحادثة يُحفظ في _chat_resume_at وليس في دلوها، لأن CallbackThrottle يحذف الدلاء
+    الخاملة بعد ثوانٍ فيعود الدلو ممتلئًا قبل انتهاء انتظار تليجرام.
+    """
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float, chat_burst: float,
+                 bulk_reserve: float, max_retries: int, max_retry_wait: float):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._private = CallbackThrottle(private_rate, chat_burst, THROTTLE_MAX_KEYS)
+        self._groups = CallbackThrottle(group_rate, chat_burst, THROTTLE_MAX_KEYS)
+        self.bulk_reserve = global_rate * bulk_reserve
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+        self._interactive_waiting = 0
+        # chat_id -> وقت استئناف الإرسال (loop.time()) بعد رد 429
+        self._chat_resume_at = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        # المحادثات الخاصة أرقام موجبة؛ المجموعات والقنوات سالبة أو @username
+        if isinstance(chat_id, int) and chat_id > 0:
+            return self._private.bucket(chat_id)
+        return self._groups.bucket(chat_id)
+
+    def _pause_chat(self, chat_id, seconds: float) -> None:
+        now = asyncio.get_running_loop().time()
+        self._chat_resume_at[chat_id] = max(self._chat_resume_at.get(chat_id, 0.0), now + seconds)
+        if len(self._chat_resume_at) > THROTTLE_MAX_KEYS:
+            self._chat_resume_at = {chat: at for chat, at in self._chat_resume_at.items() if at > now}
+
+    async def _wait_for_chat(self, chat_id) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self._chat_resume_at.get(chat_id, 0.0) - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self._chat_resume_at.pop(chat_id, None)
+        await self._chat_bucket(chat_id).take()
+
+    async def _acquire(self, chat_id, priority: str) -> None:
+        started = time.perf_counter()
+        if chat_id is not None:
+            await self._wait_for_chat(chat_id)
+        if priority == PRIORITY_BULK:
+            while True:
+                delay = 1 / self._global.rate if self._interactive_waiting else self._global.try_take(reserve=self.bulk_reserve)
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+        else:
+            self._interactive_waiting += 1
+            try:
+                await self._global.take()
+            finally:
+                self._interactive_waiting -= 1
+        TELEGRAM_LIMITER_WAIT.observe(time.perf_counter() - started, priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        limited = endpoint.startswith(RATE_LIMITED_PREFIXES)
+        chat_id = data.get('chat_id') if limited else None
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries or e.retry_after > self.max_retry_wait:
+                    raise
+                TELEGRAM_RETRIES.inc(endpoint)
+                delay = e.retry_after * (1 + random.uniform(0, TELEGRAM_RETRY_JITTER))
+                logger.warning(f"Flood limit on {endpoint}, retrying in {delay:.1f}s")
+                if chat_id is not None:
+                    self._pause_chat(chat_id, delay)
+                elif limited:
+                    self._global.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+class NotificationSender:
+    """طابور لإرسال الرسائل الجماعية في الخلفية بعدد محدود من العمال؛
+    الطلبات تمر بمسار BULK في محدد الطلبات فلا تؤخر ردود المستخدمين"""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    def start(self, bot) -> None:
+        self._tasks = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """إضافة رسالة للطابور؛ المستقبل يُكمل بـ None عند النجاح أو بنص الخطأ"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, text, kwargs, future))
+        return future
+
+    async def send_many(self, messages) -> list:
+        """messages: [(chat_id, text)] ← [(chat_id, خطأ أو None)]"""
+        futures = [await self.send(chat_id, text) for chat_id, text in messages]
+        errors = await asyncio.gather(*futures)
+        return [(chat_id, error) for (chat_id, _), error in zip(messages, errors)]
+
+    async def _worker(self, bot) -> None:
+        while True:
+            chat_id, text, kwargs, future = await self._queue.get()
+            error = None
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=BULK, **kwargs)
+            except Exception as e:
+                error = str(e)
+                logger.error(f"Failed to send message to {chat_id}: {error}")
+            if not future.done():
+                future.set_result(error)
+            self._queue.task_done()
+
+notification_sender = NotificationSender(NOTIFY_WORKERS, NOTIFY_QUEUE_SIZE)
+
+# ترحيلات قاعدة البيانات بالترتيب: (الإصدار، الوصف، SQL)
+# كل ترحيل يُطبق مرة واحدة داخل معاملة ويُسجل في جدول schema_version
+MIGRATIONS = [
+    (1, "initial schema", """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            stars INTEGER DEFAULT 0,
+            points INTEGER DEFAULT 0,
+            is_premium BOOLEAN DEFAULT FALSE,
+            premium_expiry TIMESTAMP,
+            created_at TIMESTAMP DEFAULT now(),
+            updated_at TIMESTAMP DEFAULT now(),
+            linked_channel TEXT
+        );
+        
+        CREATE TABLE IF NOT EXISTS roulettes (
+            id SERIAL PRIMARY KEY,
+            creator_id BIGINT,
+            message TEXT,
+            channel_id TEXT,
+            condition_channel_id TEXT,
+            winner_count INTEGER,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT now(),
+            message_id BIGINT,
+            chat_id BIGINT
+        );
+        
+        CREATE TABLE IF NOT EXISTS participants (
+            id SERIAL PRIMARY KEY,
+            roulette_id INTEGER REFERENCES roulettes(id) ON DELETE CASCADE,
+            user_id BIGINT,
+            username TEXT,
+            full_name TEXT,
+            joined_at TIMESTAMP DEFAULT now()
+        );
+        
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            payment_type TEXT,
+            amount INTEGER,
+            is_completed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT now(),
+            completed_at TIMESTAMP
+        );
+        
+        CREATE TABLE IF NOT EXISTS donations (
+            id SERIAL PRIMARY KEY,
+            donor_id BIGINT,
+            amount INTEGER,
+            donation_date TIMESTAMP DEFAULT now()
+        );
+        
+        CREATE TABLE IF NOT EXISTS point_transactions (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT,
+            user_id BIGINT,
+            points INTEGER,
+            transaction_date TIMESTAMP DEFAULT now(),
+            notes TEXT
+        );
+    """),
+    (2, "unique participants and participant counter", """
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS participant_count INTEGER NOT NULL DEFAULT 0;
+
+        -- مشاركة واحدة لكل مستخدم في كل سحب
+        DELETE FROM participants a
+        USING participants b
+        WHERE a.roulette_id = b.roulette_id
+          AND a.user_id = b.user_id
+          AND a.id > b.id;
+
+        CREATE UNIQUE INDEX IF NOT EXISTS participants_roulette_user_key
+            ON participants (roulette_id, user_id);
+
+        UPDATE roulettes r
+        SET participant_count = c.total
+        FROM (
+            SELECT roulette_id, COUNT(*) AS total
+            FROM participants
+            GROUP BY roulette_id
+        ) c
+        WHERE r.id = c.roulette_id;
+    """),
+    (3, "hot path indexes", """
+        -- participants_roulette_user_key يغطي البحث بـ roulette_id و (roulette_id, user_id)،
+        -- وهذا الفهرس لعرض المشاركين وسحبهم بالترتيب
+        CREATE INDEX IF NOT EXISTS participants_roulette_joined_idx
+            ON participants (roulette_id, joined_at, id);
+
+        CREATE INDEX IF NOT EXISTS roulettes_creator_id_idx
+            ON roulettes (creator_id);
+
+        CREATE INDEX IF NOT EXISTS point_transactions_user_id_idx
+            ON point_transactions (user_id);
+    """),
+    (4, "draw marker and winner delivery results", """
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS drawn_at TIMESTAMP;
+
+        CREATE TABLE IF NOT EXISTS roulette_winners (
+            roulette_id INTEGER REFERENCES roulettes(id) ON DELETE CASCADE,
+            user_id BIGINT,
+            username TEXT,
+            full_name TEXT,
+            notified BOOLEAN,
+            notify_error TEXT,
+            notified_at TIMESTAMP,
+            PRIMARY KEY (roulette_id, user_id)
+        );
+    """),
+    (5, "premium expiry job", """
+        -- تاريخ الانتهاء الذي أُرسل عنه التذكير، فالتجديد يعيد التذكير تلقائيًا
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS premium_reminded_for TIMESTAMP;
+        CREATE INDEX IF NOT EXISTS users_premium_expiry_idx ON users (premium_expiry) WHERE is_premium;
+
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id SERIAL PRIMARY KEY,
+            job TEXT NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP NOT NULL DEFAULT now(),
+            rows_processed INTEGER NOT NULL DEFAULT 0,
+            details JSONB,
+            error TEXT
+        );
+    """),
+    (6, "idempotent payments", """
+        ALTER TABLE donations ADD COLUMN IF NOT EXISTS telegram_charge_id TEXT;
+        CREATE UNIQUE INDEX IF NOT EXISTS donations_telegram_charge_id_key ON donations (telegram_charge_id);
+    """),
+    (7, "auto-close deadlines and participant caps", """
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS closes_at TIMESTAMP;
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS max_participants INTEGER;
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS auto_draw BOOLEAN NOT NULL DEFAULT FALSE;
+        -- وقت الإغلاق التلقائي؛ يميز السحب الذي أغلقه المؤقت عن الذي أوقفه المنشئ يدويًا
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS auto_closed_at TIMESTAMP;
+
+        CREATE INDEX IF NOT EXISTS roulettes_pending_timers_idx ON roulettes (closes_at)
+            WHERE drawn_at IS NULL AND (closes_at IS NOT NULL OR max_participants IS NOT NULL);
+    """),
+    # ينسخ جدول المشاركين كاملاً داخل معاملة الترحيل عند بدء التشغيل، والجدول مقفل حتى تنتهي؛
+    # مع جداول كبيرة يُفضل تشغيل أول إقلاع بعد التحديث في وقت هادئ (انظر README)
+    (8, "participants partitioned by roulette id, with archive", """
+        ALTER TABLE participants RENAME TO participants_legacy;
+        ALTER TABLE participants_legacy RENAME CONSTRAINT participants_pkey TO participants_legacy_pkey;
+        ALTER INDEX participants_roulette_user_key RENAME TO participants_legacy_roulette_user_key;
+        ALTER INDEX participants_roulette_joined_idx RENAME TO participants_legacy_roulette_joined_idx;
+
+        CREATE TABLE participants (
+            id BIGINT NOT NULL DEFAULT nextval('participants_id_seq'),
+            roulette_id INTEGER NOT NULL REFERENCES roulettes(id) ON DELETE CASCADE,
+            user_id BIGINT,
+            username TEXT,
+            full_name TEXT,
+            joined_at TIMESTAMP DEFAULT now(),
+            PRIMARY KEY (roulette_id, id)
+        ) PARTITION BY RANGE (roulette_id);
+        ALTER SEQUENCE participants_id_seq AS BIGINT OWNED BY participants.id;
+
+        CREATE UNIQUE INDEX participants_roulette_user_key ON participants (roulette_id, user_id);
+        CREATE INDEX participants_roulette_joined_idx ON participants (roulette_id, joined_at, id);
+
+        -- عدد أرقام السحوبات في كل جزء؛ المصدر الوحيد لهذا الرقم (البوت يقرؤه من هنا أيضًا)
+        CREATE OR REPLACE FUNCTION participants_partition_size() RETURNS INTEGER
+        LANGUAGE sql IMMUTABLE AS 'SELECT 10000';
+
+        -- جزء لكل participants_partition_size() سحب باسم participants_p<أول رقم>؛ القفل يمنع إنشاء نفس الجزء مرتين
+        CREATE OR REPLACE FUNCTION participants_ensure_partition(rid INTEGER) RETURNS VOID
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            size INTEGER := participants_partition_size();
+            start_id INTEGER := (rid / size) * size;
+            part_name TEXT := 'participants_p' || start_id;
+        BEGIN
+            IF to_regclass(part_name) IS NOT NULL THEN
+                RETURN;
+            END IF;
+            PERFORM pg_advisory_xact_lock(7301958421);
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF participants FOR VALUES FROM (%s) TO (%s)',
+                part_name, start_id, start_id + size
+            );
+        END $$;
+
+        DO $$
+        DECLARE
+            rid INTEGER;
+        BEGIN
+            FOR rid IN
+                SELECT DISTINCT roulette_id FROM participants_legacy WHERE roulette_id IS NOT NULL
+                UNION SELECT COALESCE(max(id), 0) FROM roulettes
+                UNION SELECT COALESCE(max(id), 0) + participants_partition_size() FROM roulettes
+            LOOP
+                PERFORM participants_ensure_partition(rid);
+            END LOOP;
+        END $$;
+
+        INSERT INTO participants (id, roulette_id, user_id, username, full_name, joined_at)
+        SELECT id, roulette_id, user_id, username, full_name, joined_at
+        FROM participants_legacy
+        WHERE roulette_id IS NOT NULL;
+
+        DROP TABLE participants_legacy;
+
+        ALTER TABLE roulettes ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP;
+
+        -- ملخص ونسخة مضغوطة (gzip JSONL) من مشاركي السحوبات المؤرشفة
+        CREATE TABLE IF NOT EXISTS participants_archive (
+            roulette_id INTEGER PRIMARY KEY REFERENCES roulettes(id) ON DELETE CASCADE,
+            participant_count INTEGER NOT NULL,
+            first_joined_at TIMESTAMP,
+            last_joined_at TIMESTAMP,
+            archived_at TIMESTAMP NOT NULL DEFAULT now(),
+            data BYTEA NOT NULL
+        );
+    """),
+    (9, "typed channel columns", """
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS linked_channel_id BIGINT,
+            ADD COLUMN IF NOT EXISTS linked_channel_username TEXT,
+            ADD COLUMN IF NOT EXISTS linked_channel_title TEXT;
+
+        -- linked_channel كان "id|username" أو "id"؛ العمود القديم يبقى كما هو ولا يُستخدم بعد الآن
+        UPDATE users
+        SET linked_channel_id = split_part(linked_channel, '|', 1)::bigint,
+            linked_channel_username = NULLIF(split_part(linked_channel, '|', 2), '')
+        WHERE linked_channel ~ '^-?[0-9]+(\\|.*)?$';
+
+        -- نسخة من قناة المنشئ وقناة الشرط وقت إنشاء السحب، حتى لا يحتاج مسار المشاركة أي بحث إضافي
+        ALTER TABLE roulettes
+            ADD COLUMN IF NOT EXISTS channel_chat_id BIGINT,
+            ADD COLUMN IF NOT EXISTS channel_username TEXT,
+            ADD COLUMN IF NOT EXISTS channel_title TEXT,
+            ADD COLUMN IF NOT EXISTS condition_chat_id BIGINT,
+            ADD COLUMN IF NOT EXISTS condition_username TEXT,
+            ADD COLUMN IF NOT EXISTS condition_title TEXT;
+
+        UPDATE roulettes
+        SET channel_chat_id = COALESCE(
+                CASE WHEN channel_id ~ '^-?[0-9]+(\\|.*)?$' THEN split_part(channel_id, '|', 1)::bigint END,
+                chat_id
+            ),
+            channel_username = NULLIF(split_part(channel_id, '|', 2), '')
+        WHERE channel_id IS NOT NULL OR chat_id IS NOT NULL;
+
+        -- قنوات الشرط القديمة المخزنة باليوزر تبقى بدون رقم، ويبحث عنها مسار المشاركة باليوزر
+        UPDATE roulettes
+        SET condition_chat_id = CASE WHEN condition_channel_id ~ '^-?[0-9]+$' THEN condition_channel_id::bigint END,
+            condition_username = CASE WHEN condition_channel_id !~ '^-?[0-9]+$' THEN ltrim(condition_channel_id, '@') END,
+            condition_title = CASE WHEN condition_channel_id ~ '^-?[0-9]+$' THEN condition_channel_id END
+        WHERE condition_channel_id IS NOT NULL;
+    """),
+]
+
+# مفتاح قفل pg_advisory_lock حتى لا تُطبق عمليتان الترحيلات في نفس الوقت
+MIGRATIONS_LOCK_ID = 7301958420
+
+async def get_schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(max(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def run_migrations(conn) -> int:
+    """تطبيق الترحيلات الناقصة، ولا شيء غير استعلام واحد إذا كانت القاعدة محدثة"""
+    latest = MIGRATIONS[-1][0]
+    current = await get_schema_version(conn)
+    if current >= latest:
+        return current
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT now()
+            )
+        """)
+        # ربما طبقتها عملية أخرى أثناء انتظار القفل
+        current = await get_schema_version(conn)
+        for version, description, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info(f"Applying database migration {version}: {description}")
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute("""
+                    INSERT INTO schema_version (version, description)
+                    VALUES ($1, $2)
+                """, version, description)
+            current = version
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+    return current
+
+async def setup_connection(conn) -> None:
+    conn.add_query_logger(record_query)
+
+async def init_db(database_url: str = None):
     """تهيئة قاعدة البيانات"""
-    if not DATABASE_URL:
+    database_url = database_url or DATABASE_URL
+    if not database_url:
         logger.error("لم يتم تعيين DATABASE_URL في متغيرات البيئة!")
         return None
     
     try:
-        pool = await asyncpg.create_pool(DATABASE_URL)
-        async with pool.acquire() as conn:
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id BIGINT PRIMARY KEY,
-                stars INTEGER DEFAULT 0,
-                points INTEGER DEFAULT 0,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_expiry TIMESTAMP,
-                created_at TIMESTAMP DEFAULT now(),
-                updated_at TIMESTAMP DEFAULT now(),
-                linked_channel TEXT
-            );
-            
-            CREATE TABLE IF NOT EXISTS roulettes (
-                id SERIAL PRIMARY KEY,
-                creator_id BIGINT,
-                message TEXT,
-                channel_id TEXT,
-                condition_channel_id TEXT,
-                winner_count INTEGER,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT now(),
-                message_id BIGINT,
-                chat_id BIGINT
-            );
-            
-            CREATE TABLE IF NOT EXISTS participants (
-                id SERIAL PRIMARY KEY,
-                roulette_id INTEGER REFERENCES roulettes(id) ON DELETE CASCADE,
-                user_id BIGINT,
-                username TEXT,
-                full_name TEXT,
-                joined_at TIMESTAMP DEFAULT now()
-            );
-            
-            CREATE TABLE IF NOT EXISTS payments (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                payment_type TEXT,
-                amount INTEGER,
-                is_completed BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT now(),
-                completed_at TIMESTAMP
-            );
-            
-            CREATE TABLE IF NOT EXISTS donations (
-                id SERIAL PRIMARY KEY,
-                donor_id BIGINT,
-                amount INTEGER,
-                donation_date TIMESTAMP DEFAULT now()
-            );
-            
-            CREATE TABLE IF NOT EXISTS point_transactions (
-                id SERIAL PRIMARY KEY,
-                admin_id BIGINT,
-                user_id BIGINT,
-                points INTEGER,
-                transaction_date TIMESTAMP DEFAULT now(),
-                notes TEXT
-            );
-            """)
+        pool = InstrumentedPool(await asyncpg.create_pool(
+            database_url,
+            min_size=min(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            server_settings=DB_SERVER_SETTINGS,
+            init=setup_connection
+        ), database_url)
+        async with pool.unbounded_connection() as conn:
+            version = await run_migrations(conn)
+        logger.info(f"Database schema version {version}")
         return pool
     except Exception as e:
         logger.error(f"فشل تهيئة قاعدة البيانات: {e}")
         return None
 
+class UserProfileCache:
+    """كاش محدود الحجم (LRU) بمدة صلاحية لنتيجة check_user_payment_status.
+
+    كل كتابة على المستخدم تستدعي invalidate، وأي قراءة بدأت قبل الإبطال
+    لا تُخزن نتيجتها حتى لا يظهر رصيد قديم بعد الكتابة.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            profile, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return apply_premium_expiry(dict(profile))
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def begin_load(self, user_id: int) -> object:
+        token = object()
+        self._loading[user_id] = token
+        return token
+
+    def finish_load(self, user_id: int, token: object, profile) -> None:
+        """تخزين نتيجة القراءة ما لم تُبطل أثناءها؛ profile=None عند فشل القراءة"""
+        if self._loading.get(user_id) is not token:
+            return
+        del self._loading[user_id]
+        if profile is None:
+            return
+        self._entries[user_id] = (dict(profile), time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids: int) -> None:
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+            self._loading.pop(user_id, None)
+
+user_cache = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def apply_premium_expiry(profile: dict) -> dict:
+    """حساب is_premium من تاريخ الانتهاء دون كتابة؛ expire_premiums تحدّث القاعدة في الخلفية"""
+    if profile['premium_expiry'] and profile['premium_expiry'] < datetime.now():
+        profile['is_premium'] = False
+        profile['premium_expiry'] = None
+    return profile
+
+class RouletteRegistry:
+    """سجل LRU لبيانات السحوبات التي يحتاجها مسار المشاركة (المنشئ والقنوات وعدد الفائزين والحالة).
+
+    يُحمّل عند أول طلب مع دمج الطلبات المتزامنة، ويُبطل عند الإيقاف والاستئناف والسحب
+    والإنشاء. السحب غير الموجود يُخزن كـ None. الاستعلام الذري للمشاركة يعيد التحقق من
+    الحالة، فالبيانات القديمة لا تسمح بمشاركة في سحب مغلق.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    async def get(self, pool, roulette_id: int):
+        entry = self._entries.get(roulette_id)
+        if entry is not None:
+            roulette, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(roulette_id)
+                self.hits += 1
+                return roulette
+            del self._entries[roulette_id]
+
+        future = self._inflight.get(roulette_id)
+        if future is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(future)
+            except LookupAbandoned:
+                return await self.get(pool, roulette_id)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[roulette_id] = future
+        try:
+            row = await pool.fetchrow("""
+                SELECT id, creator_id, message, winner_count, is_active, chat_id, message_id,
+                       channel_chat_id, condition_chat_id, condition_username, condition_title
+                FROM roulettes WHERE id = $1
+            """, roulette_id)
+            roulette = dict(row) if row else None
+        except asyncio.CancelledError:
+            future.set_exception(LookupAbandoned())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(roulette)
+            # إبطال أثناء التحميل يزيل الطلب من _inflight، فلا نخزن نتيجة ربما قديمة
+            if self._inflight.get(roulette_id) is future:
+                self._entries[roulette_id] = (roulette, time.monotonic() + self.ttl)
+                self._entries.move_to_end(roulette_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return roulette
+        finally:
+            if self._inflight.get(roulette_id) is future:
+                del self._inflight[roulette_id]
+
+    def invalidate(self, roulette_id: int) -> None:
+        self._entries.pop(roulette_id, None)
+        self._inflight.pop(roulette_id, None)
+
+roulette_registry = RouletteRegistry(ROULETTE_CACHE_SIZE, ROULETTE_CACHE_TTL)
+
+class ParticipantSet:
+    """أرقام مشاركي سحب واحد: المصفوفة المحملة من القاعدة (int64 مرتبة، بحث ثنائي) ومصفوفات
+    مرتبة صغيرة للمشاركات الأحدث، مع set لآخر المشاركات.
+
+    المصفوفة الكبيرة لا يُعاد بناؤها أبدًا؛ الدمج يقتصر على المصفوفات الصغيرة بحجم أقصى
+    PARTICIPANT_FILTER_RUN_SIZE، فلا يوقف أي دمج حلقة الأحداث أكثر من بضعة ميلي ثوانٍ
+    مهما كبر السحب.
+    """
+    __slots__ = ('ids', 'runs', 'recent')
+
+    def __init__(self, ids: array):
+        self.ids = ids
+        self.runs = []
+        self.recent = set()
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self.recent:
+            return True
+        for ids in (self.ids, *self.runs):
+            index = bisect.bisect_left(ids, user_id)
+            if index < len(ids) and ids[index] == user_id:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self.ids) + sum(len(run) for run in self.runs) + len(self.recent)
+
+    def add(self, user_id: int) -> bool:
+        if user_id in self:
+            return False
+        self.recent.add(user_id)
+        if len(self.recent) < PARTICIPANT_FILTER_MERGE_SIZE:
+            return True
+        runs = self.runs
+        runs.append(array('q', sorted(self.recent)))
+        self.recent = set()
+        # دمج ثنائي (مثل العداد الثنائي): آخر مصفوفتين تُدمجان ما دامتا متقاربتين في الحجم
+        while (len(runs) >= 2 and len(runs[-2]) <= len(runs[-1]) * 2
+               and len(runs[-2]) + len(runs[-1]) <= PARTICIPANT_FILTER_RUN_SIZE):
+            last = runs.pop()
+            runs[-1] = array('q', sorted(itertools.chain(runs[-1], last)))
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        return (sum(ids.buffer_info()[1] * ids.itemsize for ids in (self.ids, *self.runs))
+                + sys.getsizeof(self.recent))
+
+class ParticipantFilter:
+    """من شارك في كل سحب نشط، حتى تُرفض النقرات المكررة دون طلبات لتليجرام أو لقاعدة البيانات.
+
+    يُحمّل السحب من participants عند أول نقرة عليه ويُحدّث بعد كل مشاركة ناجحة. الإجابة
+    بـ "شارك" مؤكدة دائمًا؛ "لم يشارك" تمر للاستعلام الذري الذي يبقى الحَكَم عبر القيد الفريد.
+    الحجم محدود بعدد السحوبات وإجمالي الأرقام، ويُخرج الأقدم استخدامًا أولًا. السحب الذي
+    يتجاوز وحده حد الأرقام لا يُحفظ، وتمر نقراته مباشرة للاستعلام الذري.
+    """
+
+    def __init__(self, max_ids: int, max_roulettes: int):
+        self.max_ids = max_ids
+        self.max_roulettes = max_roulettes
+        self.hits = 0
+        self.misses = 0
+        self._sets = OrderedDict()
+        self._total_ids = 0
+        # سحوبات أكبر من max_ids وحدها، لا فائدة من إعادة تحميلها
+        self._oversized = set()
+        # roulette_id -> (future, المشاركات التي سُجلت أثناء التحميل)
+        self._loading = {}
+
+    async def contains(self, pool, roulette_id: int, user_id: int) -> bool:
+        if roulette_id in self._oversized:
+            return False
+        participants = self._sets.get(roulette_id)
+        if participants is not None:
+            self._sets.move_to_end(roulette_id)
+            self.hits += 1
+        else:
+            participants = await self._load(pool, roulette_id)
+        return user_id in participants
+
+    async def _load(self, pool, roulette_id: int) -> ParticipantSet:
+        loading = self._loading.get(roulette_id)
+        if loading is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(loading[0])
+            except LookupAbandoned:
+                return await self._load(pool, roulette_id)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        pending = set()
+        self._loading[roulette_id] = (future, pending)
+        try:
+            ids = array('q')
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    # الفهرس الفريد (roulette_id, user_id) يعيد الأرقام مرتبة
+                    async for row in conn.cursor("""
+                        SELECT user_id FROM participants
+                        WHERE roulette_id = $1
+                        ORDER BY user_id
+                    """, roulette_id, prefetch=DRAW_FETCH_SIZE):
+                        ids.append(row[0])
+                        if len(ids) > self.max_ids:
+                            break
+            participants = ParticipantSet(ids)
+            for user_id in pending:
+                participants.add(user_id)
+        except asyncio.CancelledError:
+            future.set_exception(LookupAbandoned())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(participants)
+            # discard أثناء التحميل يعني أن السحب انتهى فلا نحتفظ به
+            if self._loading.get(roulette_id, (None,))[0] is future:
+                self._sets[roulette_id] = participants
+                self._total_ids += len(participants)
+                self._evict()
+            return participants
+        finally:
+            if self._loading.get(roulette_id, (None,))[0] is future:
+                del self._loading[roulette_id]
+
+    def _evict(self) -> None:
+        while self._sets and (len(self._sets) > self.max_roulettes or self._total_ids > self.max_ids):
+            roulette_id, participants = self._sets.popitem(last=False)
+            self._total_ids -= len(participants)
+            if len(participants) > self.max_ids:
+                self._oversized.add(roulette_id)
+
+    def add(self, roulette_id: int, user_id: int) -> None:
+        participants = self._sets.get(roulette_id)
+        if participants is not None and participants.add(user_id):
+            self._total_ids += 1
+            if self._total_ids > self.max_ids:
+                # السحب الحالي هو الأحدث استخدامًا فيُخرج الأقدم أولًا، ثم هو إن تجاوز الحد وحده
+                self._sets.move_to_end(roulette_id)
+                self._evict()
+        loading = self._loading.get(roulette_id)
+        if loading is not None:
+            loading[1].add(user_id)
+
+    def discard(self, roulette_id: int) -> None:
+        participants = self._sets.pop(roulette_id, None)
+        if participants is not None:
+            self._total_ids -= len(participants)
+        self._oversized.discard(roulette_id)
+        self._loading.pop(roulette_id, None)
+
+    def __len__(self) -> int:
+        return len(self._sets)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(participants.nbytes for participants in self._sets.values())
+
+participant_filter = ParticipantFilter(PARTICIPANT_FILTER_MAX_IDS, PARTICIPANT_FILTER_MAX_ROULETTES)
+
 async def check_user_payment_status(user_id: int, pool) -> dict:
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    
+    token = user_cache.begin_load(user_id)
+    user_dict = None
+    try:
+        user_dict = await load_user_payment_status(user_id, pool)
+    finally:
+        user_cache.finish_load(user_id, token, user_dict)
+    return user_dict
+
+async def load_user_payment_status(user_id: int, pool) -> dict:
     async with pool.acquire() as conn:
         user = await conn.fetchrow("""
-            SELECT is_premium, premium_expiry, stars, points, linked_channel
+            SELECT is_premium, premium_expiry, stars, points,
+                   linked_channel_id, linked_channel_username, linked_channel_title
             FROM users WHERE telegram_id = $1
         """, user_id)
         
         if not user:
-            await conn.execute("INSERT INTO users (telegram_id) VALUES ($1)", user_id)
+            await conn.execute("INSERT INTO users (telegram_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
             return {
                 'is_premium': False,
                 'premium_expiry': None,
                 'stars': 0,
                 'points': 0,
-                'linked_channel': None
+                'linked_channel_id': None,
+                'linked_channel_username': None,
+                'linked_channel_title': None
             }
         
         user_dict = dict(user)
 
-        if (user_dict['is_premium'] and 
-            user_dict['premium_expiry'] and 
-            user_dict['premium_expiry'] < datetime.now()):
-            await conn.execute("""
-                UPDATE users 
-                SET is_premium = FALSE, premium_expiry = NULL 
-                WHERE telegram_id = $1
-            """, user_id)
-            user_dict['is_premium'] = False
-            user_dict['premium_expiry'] = None
+    return apply_premium_expiry(user_dict)
 
-        return user_dict
+async def record_job_run(pool, job: str, started_at: datetime, rows: int, details: dict, error: str = None) -> None:
+    """تسجيل تشغيل مهمة دورية في job_runs وفي المقاييس"""
+    for action, count in details.items():
+        JOB_ROWS.inc(job, action, amount=count)
+    try:
+        await pool.execute("""
+            INSERT INTO job_runs (job, started_at, rows_processed, details, error)
+            VALUES ($1, $2, $3, $4, $5)
+        """, job, started_at, rows, json.dumps(details), error)
+    except Exception as e:
+        logger.error(f"تعذر تسجيل تشغيل {job}: {e}")
 
-async def process_payment(user_id: int, payment_type: str, pool, use_points: bool = False) -> bool:
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT stars, points FROM users WHERE telegram_id = $1", user_id)
-        if not user:
-            return False
-            
-        required_amount = PRICES.get(payment_type, 0)
-        balance = user['points'] if use_points else user['stars']
-        
-        if balance < required_amount:
-            return False
-            
-        if use_points:
-            await conn.execute("""
-                UPDATE users SET points = points - $1 WHERE telegram_id = $2
-            """, required_amount, user_id)
-        else:
-            await conn.execute("""
-                UPDATE users SET stars = stars - $1 WHERE telegram_id = $2
-            """, required_amount, user_id)
-        
-        if payment_type == 'premium_month':
-            expiry_date = datetime.now() + timedelta(days=30)
-            await conn.execute("""
-                UPDATE users 
-                SET is_premium = TRUE, premium_expiry = $1 
-                WHERE telegram_id = $2
-            """, expiry_date, user_id)
-        
-        await conn.execute("""
-            INSERT INTO payments (user_id, payment_type, amount, is_completed, completed_at)
-            VALUES ($1, $2, $3, TRUE, now())
-        """, user_id, payment_type, required_amount)
-        
-        return True
+async def run_periodic(job, pool, interval: float) -> None:
+    """تشغيل مهمة دورية كل interval ثانية؛ فشل تشغيل لا يوقف التشغيلات التالية"""
+    while True:
+        try:
+            await job(pool)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"فشل تنفيذ {job.__name__}: {e}")
+        await asyncio.sleep(interval)
+
+PREMIUM_REMINDER_TEXT = (
+    "⏳ ينتهي اشتراكك المميز في {expiry:%Y-%m-%d %H:%M}.\n"
+    "جدد اشتراكك من القائمة الرئيسية حتى لا تفقد ميزاته."
+)
 
+async def expire_premiums(pool) -> dict:
+    """مهمة دورية: إنهاء كل الاشتراكات المنتهية باستعلام واحد، ثم تذكير من يقترب انتهاء اشتراكه"""
+    started_at = datetime.now()
+    result = {'expired': 0, 'reminded': 0, 'reminder_errors': 0}
+    error = None
+    try:
+        expired = await pool.fetch("""
+            UPDATE users SET is_premium = FALSE, premium_expiry = NULL
+            WHERE is_premium AND premium_expiry < $1
+            RETURNING telegram_id
+        """, started_at)
+        result['expired'] = len(expired)
+        user_cache.invalidate(*(row['telegram_id'] for row in expired))
+
+        if PREMIUM_REMINDER_HOURS > 0:
+            remind_before = started_at + timedelta(hours=PREMIUM_REMINDER_HOURS)
+            while True:
+                # يُعلَّم التذكير قبل الإرسال حتى لا تكرره نسخة أخرى من البوت
+                batch = await pool.fetch("""
+                    UPDATE users SET premium_reminded_for = premium_expiry
+                    WHERE telegram_id IN (
+                        SELECT telegram_id FROM users
+                        WHERE is_premium
+                          AND premium_expiry BETWEEN $1 AND $2
+                          AND premium_reminded_for IS DISTINCT FROM premium_expiry
+                        ORDER BY premium_expiry
+                        LIMIT $3
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING telegram_id, premium_expiry
+                """, started_at, remind_before, PREMIUM_REMINDER_BATCH)
+                if not batch:
+                    break
+                results = await notification_sender.send_many([
+                    (row['telegram_id'], PREMIUM_REMINDER_TEXT.format(expiry=row['premium_expiry']))
+                    for row in batch
+                ])
+                result['reminded'] += len(batch)
+                result['reminder_errors'] += sum(1 for _, send_error in results if send_error)
+                if len(batch) < PREMIUM_REMINDER_BATCH:
+                    break
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        await record_job_run(pool, 'expire_premiums', started_at, result['expired'] + result['reminded'], result, error)
+    if result['expired'] or result['reminded']:
+        logger.info(f"expire_premiums: {result}")
+    return result
+
+# خصم الرصيد وتمديد الاشتراك وتسجيل الدفعة في استعلام واحد؛ الخصم مشروط بكفاية الرصيد
+# فلا تستطيع ضغطتان متزامنتان السحب بأكثر من الرصيد. {column} من PAYMENT_BALANCE_COLUMNS فقط
+PROCESS_PAYMENT_SQL = """
+    WITH debited AS (
+        UPDATE users
+        SET {column} = {column} - $2,
+            is_premium = CASE WHEN $3 THEN TRUE ELSE is_premium END,
+            premium_expiry = CASE
+                WHEN $3 THEN GREATEST(COALESCE(premium_expiry, $4::timestamp), $4::timestamp) + interval '30 days'
+                ELSE premium_expiry
+            END
+        WHERE telegram_id = $1 AND {column} >= $2
+        RETURNING {column} AS balance, premium_expiry
+    ), recorded AS (
+        INSERT INTO payments (user_id, payment_type, amount, is_completed, completed_at)
+        SELECT $1, $5, $2, TRUE, now() FROM debited
+    )
+    SELECT balance, premium_expiry FROM debited
+"""
+PAYMENT_BALANCE_COLUMNS = {True: 'points', False: 'stars'}
+
+async def process_payment(user_id: int, payment_type: str, pool, use_points: bool = False):
+    """الدفع من رصيد النقاط أو النجوم ← {'balance', 'premium_expiry'} أو None إذا لم يكفِ الرصيد"""
+    required_amount = PRICES.get(payment_type, 0)
+    sql = PROCESS_PAYMENT_SQL.format(column=PAYMENT_BALANCE_COLUMNS[use_points])
+    result = await pool.fetchrow(
+        sql, user_id, required_amount, payment_type == 'premium_month', datetime.now(), payment_type
+    )
+    if result is None:
+        return None
+
+    user_cache.invalidate(user_id)
+    return dict(result)
+
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     user_id = user.id
@@ -231,8 +1713,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ADMIN_MENU
     
     try:
-        member = await context.bot.get_chat_member(CHANNEL, user_id)
-        if member.status not in ['member', 'administrator', 'creator']:
+        if not await membership_cache.is_member(context.bot, CHANNEL, user_id):
             await show_channel_subscription(update, context)
             return START
     except Exception as e:
@@ -271,49 +1752,139 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
 
+@instrumented
 async def admin_add_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await safe_answer_query(query)
     await query.edit_message_text(
         text="أرسل معرف المستخدم وعدد النقاط التي تريد إضافتها بالصيغة التالية:\n\n"
              "user_id:points\n\n"
-             "مثال:\n123456789:100",
+             "مثال:\n123456789:100\n\n"
+             "يمكنك إرسال عدة أسطر في رسالة واحدة، أو ملف CSV بالأعمدة user_id,points[,notes]",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("رجوع", callback_data='admin_menu')]])
     )
     return ADMIN_MENU
 
+def parse_points_rows(rows) -> tuple:
+    """rows: [(رقم السطر, [الحقول])] ← (منح صالحة [(سطر, user_id, points, notes)], أخطاء [(سطر, سبب)])"""
+    grants = []
+    errors = []
+    for line_no, fields in rows:
+        fields = [field.strip() for field in fields]
+        if not any(fields):
+            continue
+        if len(fields) < 2:
+            errors.append((line_no, "الصيغة غير صحيحة"))
+            continue
+        try:
+            target_user_id = int(fields[0])
+            points = int(fields[1])
+        except ValueError:
+            # السطر الأول في ملفات CSV غالبًا عناوين الأعمدة
+            if line_no == 1 and not fields[0].lstrip('-').isdigit():
+                continue
+            errors.append((line_no, "معرف المستخدم أو عدد النقاط ليس رقمًا"))
+            continue
+        if target_user_id <= 0:
+            errors.append((line_no, "معرف المستخدم غير صالح"))
+        elif not points or abs(points) > POINTS_LIMIT:
+            errors.append((line_no, "عدد النقاط غير صالح"))
+        else:
+            notes = fields[2] if len(fields) > 2 and fields[2] else "إضافة نقاط من قبل المشرف"
+            grants.append((line_no, target_user_id, points, notes))
+    return grants, errors
+
+async def apply_point_grants(pool, admin_id: int, grants: list) -> dict:
+    """تطبيق كل المنح في معاملة واحدة، مع إنشاء المستخدمين غير الموجودين ← {user_id: (الرصيد الجديد, مستخدم جديد)}"""
+    totals = {}
+    for _, target_user_id, points, _ in grants:
+        totals[target_user_id] = totals.get(target_user_id, 0) + points
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            balances = await conn.fetch("""
+                INSERT INTO users (telegram_id, points)
+                SELECT * FROM unnest($1::bigint[], $2::integer[])
+                ON CONFLICT (telegram_id) DO UPDATE SET points = users.points + EXCLUDED.points
+                RETURNING telegram_id, points, (xmax = 0) AS created
+            """, list(totals), list(totals.values()))
+            await conn.copy_records_to_table(
+                'point_transactions',
+                records=[(admin_id, target_user_id, points, notes) for _, target_user_id, points, notes in grants],
+                columns=['admin_id', 'user_id', 'points', 'notes']
+            )
+    return {row['telegram_id']: (row['points'], row['created']) for row in balances}
+
+async def read_points_document(document) -> list:
+    """قراءة ملف CSV المرفوع ← [(رقم السطر, [الحقول])]"""
+    data = await (await document.get_file()).download_as_bytearray()
+    text = bytes(data).decode('utf-8-sig')
+    return [(line_no, fields) for line_no, fields in enumerate(csv.reader(io.StringIO(text)), start=1)]
+
+@instrumented
 async def admin_handle_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    text = update.message.text
+    document = update.message.document
     pool = context.bot_data.get('pool')
-    
+
+    if user_id not in ADMINS:
+        return ADMIN_MENU
+
     try:
-        if ':' in text:
-            target_user_id, points = text.split(':')
-            target_user_id = int(target_user_id.strip())
-            points = int(points.strip())
-            
-            async with pool.acquire() as conn:
-                await conn.execute("""
-                    UPDATE users SET points = points + $1 WHERE telegram_id = $2
-                """, points, target_user_id)
-                
-                await conn.execute("""
-                    INSERT INTO point_transactions (admin_id, user_id, points, notes)
-                    VALUES ($1, $2, $3, $4)
-                """, user_id, target_user_id, points, "إضافة نقاط من قبل المشرف")
-                
-            await update.message.reply_text(f"تم إضافة {points} نقطة للمستخدم {target_user_id} بنجاح!")
+        if document:
+            if document.file_size and document.file_size > BULK_POINTS_MAX_FILE_SIZE:
+                await update.message.reply_text("حجم الملف كبير جدًا. الحد الأقصى 5 ميجابايت.")
+                await show_admin_menu(update, context)
+                return ADMIN_MENU
+            rows = await read_points_document(document)
         else:
+            rows = [
+                (line_no, re.split(r'[:,]', line, maxsplit=2))
+                for line_no, line in enumerate(update.message.text.splitlines(), start=1)
+            ]
+
+        grants, errors = parse_points_rows(rows)
+        if len(grants) > BULK_POINTS_MAX_ROWS:
+            await update.message.reply_text(f"عدد الأسطر كبير جدًا. الحد الأقصى {BULK_POINTS_MAX_ROWS} سطر في المرة.")
+        elif not grants:
             await update.message.reply_text("الصيغة غير صحيحة. يرجى استخدام الصيغة: user_id:points")
-            
+            if errors:
+                await send_points_report(update, [], errors, {})
+        else:
+            balances = await apply_point_grants(pool, user_id, grants)
+            user_cache.invalidate(*balances)
+            await send_points_report(update, grants, errors, balances)
+
+    except UnicodeDecodeError:
+        await update.message.reply_text("تعذرت قراءة الملف. يرجى حفظه بترميز UTF-8.")
     except Exception as e:
         logger.error(f"Error in admin_handle_points: {e}")
-        await update.message.reply_text("حدث خطأ أثناء معالجة طلبك. يرجى المحاولة مرة أخرى.")
+        await update.message.reply_text("حدث خطأ أثناء معالجة طلبك، ولم تتم إضافة أي نقاط. يرجى المحاولة مرة أخرى.")
     
     await show_admin_menu(update, context)
     return ADMIN_MENU
 
+async def send_points_report(update: Update, grants: list, errors: list, balances: dict) -> None:
+    """تقرير لكل سطر؛ يُرسل كملف إذا تجاوز حد طول الرسالة"""
+    lines = []
+    for line_no, target_user_id, points, _ in grants:
+        balance, created = balances[target_user_id]
+        lines.append((line_no, f"✅ سطر {line_no}: {points:+} نقطة للمستخدم {target_user_id} "
+                               f"(الرصيد {balance}{'، مستخدم جديد' if created else ''})"))
+    lines.extend((line_no, f"❌ سطر {line_no}: {reason}") for line_no, reason in errors)
+    lines.sort()
+
+    summary = f"تمت إضافة النقاط: {len(grants)} سطر ناجح، {len(errors)} سطر مرفوض."
+    body = "\n".join(line for _, line in lines)
+    if len(summary) + len(body) < 4000:
+        await update.message.reply_text(f"{summary}\n\n{body}")
+    else:
+        await update.message.reply_document(
+            document=io.BytesIO(body.encode()),
+            filename="points_report.txt",
+            caption=summary
+        )
+
 async def show_channel_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("قناتنا", url=f"https://t.me/{CHANNEL[1:]}")],
@@ -328,13 +1899,14 @@ async def show_channel_subscription(update: Update, context: ContextTypes.DEFAUL
         reply_markup=reply_markup
     )
 
+@instrumented
 async def subscribed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = query.from_user.id
     
     try:
-        member = await context.bot.get_chat_member(CHANNEL, user_id)
-        if member.status not in ['member', 'administrator', 'creator']:
+        # المستخدم يؤكد أنه اشترك للتو، لذلك لا نعتمد على نتيجة سلبية مخزنة
+        if not await membership_cache.is_member(context.bot, CHANNEL, user_id, trust_negative=False):
             # رد وحيد لو مش مشترك
             await safe_answer_query(query, "لم يتم العثور على اشتراكك. يرجى الاشتراك أولاً!", show_alert=True)
             return START
@@ -395,6 +1967,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
 
+@instrumented
 async def create_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await safe_answer_query(query)
@@ -402,7 +1975,7 @@ async def create_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     pool = context.bot_data.get('pool')
     
     user_status = await check_user_payment_status(user_id, pool)
-    if not user_status['linked_channel']:
+    if not user_status['linked_channel_id']:
         await query.edit_message_text(
             text="⚠️ يجب ربط قناة أولاً قبل إنشاء السحب\n\n"
                  "يرجى ربط قناة من القائمة الرئيسية ثم المحاولة مرة أخرى",
@@ -430,6 +2003,7 @@ async def create_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     return WAITING_FOR_TEXT
 
+@instrumented
 async def handle_roulette_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.from_user.id
     roulette_text = update.message.text
@@ -451,6 +2025,7 @@ async def handle_roulette_text(update: Update, context: ContextTypes.DEFAULT_TYP
     
     return ADD_CHANNEL
 
+@instrumented
 async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = query.from_user.id
@@ -478,9 +2053,11 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     amount = PRICES.get(payment_key, 0)
     
     if use_points:
-        payment_success = await process_payment(user_id, payment_key, pool, use_points=True)
-        if payment_success:
-            await safe_answer_query(query, f"تم الدفع بنجاح باستخدام {amount} نقطة!", show_alert=True)
+        payment = await process_payment(user_id, payment_key, pool, use_points=True)
+        if payment is not None:
+            await safe_answer_query(
+                query, f"تم الدفع بنجاح باستخدام {amount} نقطة!\nرصيدك المتبقي: {payment['balance']} نقطة", show_alert=True
+            )
             await query.edit_message_text(
                 text="❗️الخطوة التالية: أرسل يوزر القناة (مثال: @ChannelName) أو حول رسالة من القناة\n\n"
                      "⚠️ يجب أن يكون البوت أدمن في القناة",
@@ -510,6 +2087,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await safe_answer_query(query, "حدث خطأ أثناء إعداد عملية الدفع. يرجى المحاولة لاحقًا.", show_alert=True)
             return PAYMENT
 
+@instrumented
 async def handle_link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     current_state = context.user_data.get('link_channel_purpose')
@@ -529,10 +2107,13 @@ async def handle_link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
             return LINK_CHANNEL if current_state == 'main_channel' else WAITING_FOR_WINNERS
 
         if current_state == 'main_channel':
-            channel_info = f"{chat.id}|{chat.username}" if chat.username else str(chat.id)
-            
             async with context.bot_data['pool'].acquire() as conn:
-                await conn.execute("UPDATE users SET linked_channel = $1 WHERE telegram_id = $2", channel_info, user_id)
+                await conn.execute("""
+                    UPDATE users
+                    SET linked_channel_id = $1, linked_channel_username = $2, linked_channel_title = $3
+                    WHERE telegram_id = $4
+                """, chat.id, chat.username, chat.title, user_id)
+            user_cache.invalidate(user_id)
             
             await update.message.reply_text(
                 f"✅ تم ربط القناة الرئيسية بنجاح!\n\n"
@@ -542,7 +2123,8 @@ async def handle_link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
             await show_main_menu(update, context)
             return MAIN_MENU
         else:
-            context.user_data['required_channel'] = f"@{chat.username}" if chat.username else str(chat.id)
+            # الرقم يُحفظ مرة واحدة هنا فلا يحتاج التحقق من الاشتراك للبحث باليوزر
+            context.user_data['required_channel'] = {'id': chat.id, 'username': chat.username, 'title': chat.title}
             
             await update.message.reply_text(
                 "الآن اختر عدد الفائزين:",
@@ -566,6 +2148,7 @@ async def handle_link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
 """)
         return LINK_CHANNEL if current_state == 'main_channel' else WAITING_FOR_WINNERS
 
+@instrumented
 async def link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await safe_answer_query(query)
@@ -579,6 +2162,7 @@ async def link_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return LINK_CHANNEL
 
+@instrumented
 async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = query.from_user.id
@@ -624,6 +2208,7 @@ async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         
         return WAITING_FOR_WINNERS
 
+@instrumented
 async def skip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await safe_answer_query(query)
@@ -640,31 +2225,76 @@ async def skip_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     )
     return WAITING_FOR_WINNERS
 
+@instrumented
 async def set_winners(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await safe_answer_query(query)
+    context.user_data['winners_count'] = int(query.data.split('_')[1])
+
+    hours_labels = {1: "ساعة", 6: "6 ساعات", 24: "24 ساعة", 72: "3 أيام"}
+    await query.edit_message_text(
+        text="متى يُغلق السحب ويُسحب الفائزون تلقائيًا؟",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"⏰ بعد {hours_labels.get(h, f'{h} ساعة')}", callback_data=f'autoclose_t_{h}')
+             for h in AUTO_CLOSE_HOURS[:2]],
+            [InlineKeyboardButton(f"⏰ بعد {hours_labels.get(h, f'{h} ساعة')}", callback_data=f'autoclose_t_{h}')
+             for h in AUTO_CLOSE_HOURS[2:]],
+            [InlineKeyboardButton(f"👥 عند {c} مشارك", callback_data=f'autoclose_c_{c}') for c in AUTO_CLOSE_CAPS[:2]],
+            [InlineKeyboardButton(f"👥 عند {c} مشارك", callback_data=f'autoclose_c_{c}') for c in AUTO_CLOSE_CAPS[2:]],
+            [InlineKeyboardButton("بدون (إغلاق وسحب يدوي)", callback_data='autoclose_none')],
+            [InlineKeyboardButton("رجوع", callback_data='back_to_main')]
+        ])
+    )
+    return WAITING_FOR_WINNERS
+
+@instrumented
+async def set_auto_close(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = query.from_user.id
-    winners_count = int(query.data.split('_')[1])
     pool = context.bot_data.get('pool')
+    winners_count = context.user_data.get('winners_count')
+
+    if not winners_count or 'roulette_text' not in context.user_data:
+        await safe_answer_query(query, "انتهت صلاحية هذه الخطوة، ابدأ إنشاء السحب من جديد.", show_alert=True)
+        return MAIN_MENU
 
-    context.user_data['winners_count'] = winners_count
+    closes_at = None
+    max_participants = None
+    option = query.data.split('_')
+    if option[1] == 't' and int(option[2]) in AUTO_CLOSE_HOURS:
+        closes_at = datetime.now() + timedelta(hours=int(option[2]))
+    elif option[1] == 'c' and int(option[2]) in AUTO_CLOSE_CAPS:
+        max_participants = int(option[2])
 
     try:
+        user_status = await check_user_payment_status(user_id, pool)
+        if not user_status['linked_channel_id']:
+            await safe_answer_query(query, "❌ لا توجد قناة مربوطة!", show_alert=True)
+            return MAIN_MENU
+
+        roulette_text = context.user_data['roulette_text']
+        # قناة الشرط محفوظة برقمها من handle_link_channel
+        required_channel = context.user_data.get('required_channel') or {}
+
         async with pool.acquire() as conn:
             roulette_id = await conn.fetchval("""
                 INSERT INTO roulettes (
-                    creator_id, message, condition_channel_id, winner_count, is_active
-                ) VALUES ($1, $2, $3, $4, TRUE)
+                    creator_id, message, winner_count, is_active,
+                    closes_at, max_participants, auto_draw,
+                    channel_chat_id, channel_username, channel_title,
+                    condition_chat_id, condition_username, condition_title
+                ) VALUES ($1, $2, $3, TRUE, $4, $5, $6, $7, $8, $9, $10, $11, $12)
                 RETURNING id
-            """, user_id, context.user_data['roulette_text'], 
-                   context.user_data.get('required_channel'), winners_count)
-
-            roulette_text = context.user_data['roulette_text']
-            required_channel = context.user_data.get('required_channel')
-
-            message_text = f"{roulette_text}\n\n"
-            if required_channel:
-                message_text += f"⚡ شرط السحب: الاشتراك في {required_channel}\n\n"
-            message_text += f"عدد المشاركين: 0\n\nروليت باندا @Roulette_Panda_Bot"
+            """, user_id, roulette_text, winners_count,
+                   closes_at, max_participants, bool(closes_at or max_participants),
+                   user_status['linked_channel_id'], user_status['linked_channel_username'],
+                   user_status['linked_channel_title'],
+                   required_channel.get('id'), required_channel.get('username'), required_channel.get('title'))
+            await ensure_participant_partition(conn, roulette_id)
+
+            message_text = render_roulette_post(
+                roulette_text, channel_label(required_channel.get('username'), required_channel.get('title')), 0
+            )
 
             keyboard = [
                 [InlineKeyboardButton("المشاركة في السحب", callback_data=f'join_{roulette_id}')],
@@ -676,17 +2306,9 @@ async def set_winners(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            user_status = await check_user_payment_status(user_id, pool)
-            channel_info = user_status.get('linked_channel')
-
-            if not channel_info:
-                await safe_answer_query(query, "❌ لا توجد قناة مربوطة!", show_alert=True)
-                return MAIN_MENU
-
-            channel_id = channel_info.split('|')[0]
             try:
                 message = await context.bot.send_message(
-                    chat_id=int(channel_id),
+                    chat_id=user_status['linked_channel_id'],
                     text=message_text,
                     reply_markup=reply_markup,
                     parse_mode=ParseMode.HTML
@@ -698,190 +2320,272 @@ async def set_winners(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
             await conn.execute("""
                 UPDATE roulettes 
-                SET message_id = $1, chat_id = $2, channel_id = $3
-                WHERE id = $4
-            """, message.message_id, message.chat.id, channel_info, roulette_id)
+                SET message_id = $1, chat_id = $2
+                WHERE id = $3
+            """, message.message_id, message.chat.id, roulette_id)
+            roulette_registry.invalidate(roulette_id)
 
             manage_keyboard = [
                 [InlineKeyboardButton("🎲 ابدأ السحب", callback_data=f'draw_{roulette_id}')],
                 [InlineKeyboardButton("⛔ أوقف المشاركة", callback_data=f'stop_{roulette_id}')],
-                [InlineKeyboardButton("👥 عرض المشاركين", callback_data=f'view_participants_{roulette_id}')]
+                [InlineKeyboardButton("👥 عرض المشاركين", callback_data=f'view_participants_{roulette_id}')],
+                [InlineKeyboardButton("📤 تصدير المشاركين", callback_data=f'export_participants_{roulette_id}')]
             ]
 
+            if closes_at:
+                schedule_text = f"⏰ سيُغلق السحب ويُسحب الفائزون تلقائيًا في {closes_at:%Y-%m-%d %H:%M}\n\n"
+                roulette_scheduler.schedule(roulette_id, closes_at)
+            elif max_participants:
+                schedule_text = f"👥 سيُغلق السحب ويُسحب الفائزون تلقائيًا عند وصول المشاركين إلى {max_participants}\n\n"
+            else:
+                schedule_text = ""
+
             await context.bot.send_message(
                 chat_id=user_id,
-                text="✅ تم إنشاء السحب بنجاح!\n\nيمكنك إدارة السحب من هنا:",
+                text=f"✅ تم إنشاء السحب بنجاح!\n\n{schedule_text}يمكنك إدارة السحب من هنا:",
                 reply_markup=InlineKeyboardMarkup(manage_keyboard)
             )
 
             return MAIN_MENU
 
     except Exception as e:
-        logger.error(f"Error in set_winners: {e}")
+        logger.error(f"Error in set_auto_close: {e}")
         await safe_answer_query(query, "❌ حدث خطأ غير متوقع. حاول لاحقًا!", show_alert=True)
         return MAIN_MENU
 
+@instrumented
 async def join_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user = query.from_user
     roulette_id = int(query.data.split('_')[1])
     pool = context.bot_data.get('pool')
     
-    async with pool.acquire() as conn:
-        roulette = await conn.fetchrow("""
-            SELECT * FROM roulettes 
-            WHERE id = $1 AND is_active = TRUE
-        """, roulette_id)
-        
-        if not roulette:
-            await safe_answer_query(query, "هذا السحب لم يعد متاحًا!", show_alert=True)
-            return
-        
-        # التحقق من الاشتراك في القناة المربوطة
+    roulette = await roulette_registry.get(pool, roulette_id)
+    
+    if not roulette or not roulette['is_active']:
+        await safe_answer_query(query, "هذا السحب لم يعد متاحًا!", show_alert=True)
+        return
+    
+    # النقرات المكررة تُرفض من الذاكرة قبل التحقق من الاشتراك
+    if await participant_filter.contains(pool, roulette_id, user.id):
+        await safe_answer_query(query, "لقد شاركت بالفعل في هذا السحب!", show_alert=True)
+        return
+    
+    condition_channel = channel_label(roulette['condition_username'], roulette['condition_title'])
+    
+    # التحقق من الاشتراك في قناة المنشئ (نسخة محفوظة في السحب وقت إنشائه)؛ النتيجة السلبية
+    # لا تؤخذ من الكاش حتى لا يُرفض مستخدم اشترك للتو (عدد النقرات محدود مسبقًا بالـ throttle)
+    try:
+        if roulette['channel_chat_id']:
+            if not await membership_cache.is_member(context.bot, roulette['channel_chat_id'], user.id,
+                                                    trust_negative=False):
+                await safe_answer_query(query, f"يجب الاشتراك في القناة أولاً!", show_alert=True)
+                return
+    except Exception as e:
+        logger.error(f"Error checking linked channel membership: {e}")
+        await safe_answer_query(query, "حدث خطأ أثناء التحقق من اشتراكك. حاول مرة أخرى!", show_alert=True)
+        return
+    
+    # التحقق من الاشتراك في قناة الشرط
+    if roulette['condition_chat_id'] or roulette['condition_username']:
         try:
-            creator_info = await conn.fetchrow("""
-                SELECT linked_channel FROM users WHERE telegram_id = $1
-            """, roulette['creator_id'])
-            
-            if creator_info and creator_info['linked_channel']:
-                channel_parts = creator_info['linked_channel'].split('|')
-                channel_id = channel_parts[0]
-                channel_username = channel_parts[1] if len(channel_parts) > 1 else None
-                
-                member = await context.bot.get_chat_member(chat_id=int(channel_id), user_id=user.id)
-                if member.status not in ['member', 'administrator', 'creator']:
-                    await safe_answer_query(query, f"يجب الاشتراك في القناة أولاً!", show_alert=True)
-                    return
+            # السحوبات القديمة قد لا تملك رقم قناة الشرط فيُبحث عنها باليوزر
+            condition_chat = roulette['condition_chat_id'] or f"@{roulette['condition_username']}"
+            if not await membership_cache.is_member(context.bot, condition_chat, user.id, trust_negative=False):
+                await safe_answer_query(query, f"يجب الاشتراك في القناة الشرط أولاً!", show_alert=True)
+                return
         except Exception as e:
-            logger.error(f"Error checking linked channel membership: {e}")
+            logger.error(f"Error checking condition channel membership: {e}")
             await safe_answer_query(query, "حدث خطأ أثناء التحقق من اشتراكك. حاول مرة أخرى!", show_alert=True)
             return
-        
-        # التحقق من الاشتراك في قناة الشرط
-        if roulette['condition_channel_id']:
-            try:
-                condition_channel = roulette['condition_channel_id']
-                if not condition_channel.startswith('@'):
-                    condition_channel = f"@{condition_channel}"
-                
-                member = await context.bot.get_chat_member(condition_channel, user.id)
-                if member.status not in ['member', 'administrator', 'creator']:
-                    await safe_answer_query(query, f"يجب الاشتراك في القناة الشرط أولاً!", show_alert=True)
-                    return
-            except Exception as e:
-                logger.error(f"Error checking condition channel membership: {e}")
-                await safe_answer_query(query, "حدث خطأ أثناء التحقق من اشتراكك. حاول مرة أخرى!", show_alert=True)
-                return
-        
-        # التحقق من المشاركة المسبقة
-        existing = await conn.fetchrow("""
-            SELECT 1 FROM participants 
-            WHERE roulette_id = $1 AND user_id = $2
-        """, roulette_id, user.id)
-        
-        if existing:
-            await safe_answer_query(query, "لقد شاركت بالفعل في هذا السحب!", show_alert=True)
-            return
-        
-        # تسجيل المشاركة
-        await conn.execute("""
+    
+    # تسجيل المشاركة وزيادة العداد في استعلام واحد؛ القيد الفريد يمنع التكرار
+    result = await pool.fetchrow("""
+        WITH target AS (
+            -- القفل يجعل التحقق من الحد الأقصى يرى آخر عدد حتى مع المشاركات المتزامنة
+            SELECT id, max_participants FROM roulettes
+            WHERE id = $1 AND is_active = TRUE
+              AND (closes_at IS NULL OR closes_at > $5)
+              AND (max_participants IS NULL OR participant_count < max_participants)
+            FOR UPDATE
+        ), inserted AS (
             INSERT INTO participants (roulette_id, user_id, username, full_name)
-            VALUES ($1, $2, $3, $4)
-        """, roulette_id, user.id, user.username, user.full_name)
-        
-        count = await conn.fetchval("""
-            SELECT COUNT(*) FROM participants 
-            WHERE roulette_id = $1
-        """, roulette_id)
-        
-        # تحديث عدد المشاركين في نفس الرسالة
-        try:
-            original_text = query.message.text
-            new_text = re.sub(
-                r'عدد المشاركين: \d+', 
-                f'عدد المشاركين: {count}', 
-                original_text
-            )
-            
-            await query.edit_message_text(
-                text=new_text,
-                reply_markup=query.message.reply_markup,
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            logger.error(f"Error updating roulette message: {e}")
-        
-        # ❌ إلغاء إرسال أي رسالة للمنشئ أو القناة
-        # (تم حذف block إرسال رسالة للمنشئ بالكامل)
+            SELECT id, $2, $3, $4 FROM target
+            ON CONFLICT (roulette_id, user_id) DO NOTHING
+            RETURNING roulette_id
+        ), counted AS (
+            UPDATE roulettes
+            SET participant_count = participant_count + 1
+            WHERE id IN (SELECT roulette_id FROM inserted)
+            RETURNING participant_count
+        )
+        SELECT EXISTS (SELECT 1 FROM target) AS is_active,
+               EXISTS (SELECT 1 FROM inserted) AS joined,
+               (SELECT participant_count FROM counted) AS participant_count,
+               (SELECT max_participants FROM target) AS max_participants
+    """, roulette_id, user.id, user.username, user.full_name, datetime.now())
+    
+    if not result['is_active']:
+        await safe_answer_query(query, "هذا السحب لم يعد متاحًا!", show_alert=True)
+        return
+    
+    participant_filter.add(roulette_id, user.id)
+    if not result['joined']:
+        await safe_answer_query(query, "لقد شاركت بالفعل في هذا السحب!", show_alert=True)
+        return
+    
+    # تحديث عدد المشاركين في المنشور يتم في الخلفية عبر المُجمِّع
+    edit_coalescer.schedule(
+        context.bot,
+        roulette_id,
+        chat_id=roulette['chat_id'],
+        message_id=roulette['message_id'],
+        roulette_text=roulette['message'],
+        condition_channel=condition_channel,
+        count=result['participant_count'],
+        reply_markup=query.message.reply_markup
+    )
+    
+    # اكتمال العدد يغلق السحب ويسحب الفائزين في الخلفية
+    if result['max_participants'] and result['participant_count'] >= result['max_participants']:
+        roulette_scheduler.trigger(roulette_id)
+    
+    # تنبيه للمستخدم
+    await safe_answer_query(query, "تمت مشاركتك في السحب بنجاح! 🎉", show_alert=True)
 
-        # تنبيه للمستخدم
-        await safe_answer_query(query, "تمت مشاركتك في السحب بنجاح! 🎉", show_alert=True)
 
 
+async def notify_winners(pool, roulette_id: int, roulette_text: str, winners: list) -> None:
+    """إرسال رسائل التهنئة للفائزين وتسجيل نتيجة التسليم لكل فائز"""
+    results = await notification_sender.send_many([
+        (winner['user_id'], f"🎉 مبروك! لقد فزت في السحب!\n\n{roulette_text}")
+        for winner in winners
+    ])
+    await pool.executemany("""
+        UPDATE roulette_winners
+        SET notified = $3, notify_error = $4, notified_at = now()
+        WHERE roulette_id = $1 AND user_id = $2
+    """, [(roulette_id, chat_id, error is None, error) for chat_id, error in results])
 
-async def draw_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    user = query.from_user
-    roulette_id = int(query.data.split('_')[1])
-    pool = context.bot_data.get('pool')
-    
-    
+async def perform_draw(application, pool, roulette_id: int, creator_id: int = None, update=None) -> str:
+    """سحب الفائزين ونشرهم وإرسال التهاني في الخلفية؛ يستخدمه زر السحب والسحب التلقائي.
+
+    creator_id=None يتخطى التحقق من الصلاحية (للمؤقت). يعيد 'ok' أو سبب الرفض:
+    'not_found' أو 'drawn' أو 'archived' أو 'active' أو 'not_enough'.
+    """
     async with pool.acquire() as conn:
         roulette = await conn.fetchrow("""
             SELECT * FROM roulettes 
-            WHERE id = $1 AND creator_id = $2
-        """, roulette_id, user.id)
+            WHERE id = $1 AND ($2::bigint IS NULL OR creator_id = $2)
+        """, roulette_id, creator_id)
         
         if not roulette:
-            await safe_answer_query(query, "هذا السحب لم يعد متاحًا أو ليس لديك صلاحية!", show_alert=True)
-            return
-        
-        if roulette['is_active']:
-            await safe_answer_query(query, "يجب إيقاف المشاركة أولاً قبل السحب!", show_alert=True)
-            return
+            return 'not_found'
         
-        participants = await conn.fetch("""
-            SELECT user_id, username, full_name FROM participants 
-            WHERE roulette_id = $1
-        """, roulette_id)
+        if roulette['drawn_at']:
+            return 'drawn'
         
-        if len(participants) < roulette['winner_count']:
-            await safe_answer_query(query, "عدد المشاركين أقل من عدد الفائزين المطلوب!", show_alert=True)
-            return
+        if roulette['archived_at']:
+            return 'archived'
         
-        winners = random.sample(participants, roulette['winner_count'])
+        if roulette['is_active']:
+            return 'active'
         
-        message_text = f"{roulette['message']}\n\n🎉🎉🎉\n\n"
-        if roulette['condition_channel_id']:
-            message_text += f"الشرط: تشترك هنا {roulette['condition_channel_id']}\n\n"
+        if roulette['participant_count'] < roulette['winner_count']:
+            return 'not_enough'
         
-        winners_text = "\n".join([f"🎖 {winner['full_name']} (@{winner['username']})" for winner in winners])
-        message_text += f"الفائزون:\n{winners_text}\n\nروليت باندا @Roulette_Panda_Bot"
+        # المشاركون يُقرؤون على دفعات عبر cursor ولا نحتفظ إلا بالفائزين
+        async with conn.transaction():
+            participants = conn.cursor("""
+                SELECT user_id, username, full_name FROM participants 
+                WHERE roulette_id = $1
+            """, roulette_id, prefetch=DRAW_FETCH_SIZE)
+            winners = await reservoir_sample(participants, roulette['winner_count'])
+            
+            if len(winners) < roulette['winner_count']:
+                return 'not_enough'
+            
+            # تعليم السحب كمنتهي قبل أي إرسال، والشرط يمنع سحبين متزامنين
+            # ويمنع السحب إن استُؤنفت المشاركة بعد قراءة الحالة
+            marked = await conn.fetchval("""
+                UPDATE roulettes 
+                SET drawn_at = now()
+                WHERE id = $1 AND drawn_at IS NULL AND archived_at IS NULL AND is_active = FALSE
+                RETURNING id
+            """, roulette_id)
+            
+            if marked:
+                await conn.executemany("""
+                    INSERT INTO roulette_winners (roulette_id, user_id, username, full_name)
+                    VALUES ($1, $2, $3, $4)
+                """, [(roulette_id, w['user_id'], w['username'], w['full_name']) for w in winners])
         
-        await context.bot.edit_message_text(
+        if not marked:
+            # تغيرت الحالة أثناء القراءة: نعيد السبب الفعلي
+            current = await conn.fetchrow("""
+                SELECT drawn_at, archived_at, is_active FROM roulettes WHERE id = $1
+            """, roulette_id)
+    
+    roulette_registry.invalidate(roulette_id)
+    if not marked:
+        if current is None:
+            return 'not_found'
+        if current['drawn_at']:
+            return 'drawn'
+        if current['archived_at']:
+            return 'archived'
+        return 'active'
+    participant_filter.discard(roulette_id)
+    
+    message_text = f"{roulette['message']}\n\n🎉🎉🎉\n\n"
+    condition_channel = channel_label(roulette['condition_username'], roulette['condition_title'])
+    if condition_channel:
+        message_text += f"الشرط: تشترك هنا {condition_channel}\n\n"
+    
+    winners_text = "\n".join([f"🎖 {winner['full_name']} (@{winner['username']})" for winner in winners])
+    message_text += f"الفائزون:\n{winners_text}\n\nروليت باندا @Roulette_Panda_Bot"
+    
+    edit_coalescer.forget(roulette_id)
+    try:
+        await application.bot.edit_message_text(
             chat_id=roulette['chat_id'],
             message_id=roulette['message_id'],
             text=message_text,
             parse_mode=ParseMode.HTML
         )
-        
-        await safe_answer_query(query, "تم سحب الفائزين بنجاح!", show_alert=True)
-        
-        for winner in winners:
-            try:
-                await context.bot.send_message(
-                    chat_id=winner['user_id'],
-                    text=f"🎉 مبروك! لقد فزت في السحب!\n\n{roulette['message']}"
-                )
-            except Exception as e:
-                logger.error(f"Failed to notify winner {winner['user_id']}: {e}")
-        
-        await conn.execute("""
-            UPDATE roulettes 
-            SET is_active = FALSE 
-            WHERE id = $1
-        """, roulette_id)
+    except Exception as e:
+        logger.error(f"Error publishing winners for roulette {roulette_id}: {e}")
+    
+    # رسائل الفائزين تُرسل في الخلفية دون انتظارها
+    application.create_task(
+        notify_winners(pool, roulette_id, roulette['message'], winners),
+        update=update
+    )
+    return 'ok'
+
+DRAW_REFUSALS = {
+    'not_found': "هذا السحب لم يعد متاحًا أو ليس لديك صلاحية!",
+    'drawn': "تم سحب الفائزين في هذا السحب مسبقًا!",
+    'archived': "انتهت مدة هذا السحب ونُقل مشاركوه إلى الأرشيف!",
+    'active': "يجب إيقاف المشاركة أولاً قبل السحب!",
+    'not_enough': "عدد المشاركين أقل من عدد الفائزين المطلوب!",
+}
+
+@instrumented
+async def draw_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user = query.from_user
+    roulette_id = int(query.data.split('_')[1])
+    pool = context.bot_data.get('pool')
+    
+    status = await perform_draw(context.application, pool, roulette_id, creator_id=user.id, update=update)
+    if status != 'ok':
+        await safe_answer_query(query, DRAW_REFUSALS[status], show_alert=True)
+        return
+    
+    await safe_answer_query(query, "تم سحب الفائزين بنجاح!", show_alert=True)
 
+@instrumented
 async def stop_participation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user = query.from_user
@@ -895,37 +2599,42 @@ async def stop_participation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     async with pool.acquire() as conn:
         roulette = await conn.fetchrow("""
-            SELECT is_active, chat_id, message_id FROM roulettes 
+            SELECT is_active, drawn_at, archived_at, chat_id, message_id FROM roulettes 
             WHERE id = $1 AND creator_id = $2
         """, roulette_id, user.id)
         
         if not roulette:
             await safe_answer_query(query, "ليس لديك صلاحية لإدارة هذا السحب!", show_alert=True)
             return
+        
+        if roulette['drawn_at']:
+            await safe_answer_query(query, "تم سحب الفائزين في هذا السحب مسبقًا!", show_alert=True)
+            return
+        
+        if roulette['archived_at']:
+            await safe_answer_query(query, DRAW_REFUSALS['archived'], show_alert=True)
+            return
             
         new_status = not roulette['is_active']
         
+        # الاستئناف بعد انتهاء الموعد أو اكتمال العدد يلغي الإغلاق التلقائي الذي تحقق
         result = await conn.execute("""
             UPDATE roulettes 
-            SET is_active = $1 
-            WHERE id = $2 AND creator_id = $3
-        """, new_status, roulette_id, user.id)
+            SET is_active = $1,
+                closes_at = CASE WHEN $1 AND closes_at <= $4 THEN NULL ELSE closes_at END,
+                max_participants = CASE WHEN $1 AND participant_count >= max_participants THEN NULL
+                                        ELSE max_participants END,
+                auto_closed_at = CASE WHEN $1 THEN NULL ELSE auto_closed_at END
+            WHERE id = $2 AND creator_id = $3 AND drawn_at IS NULL AND archived_at IS NULL
+        """, new_status, roulette_id, user.id, datetime.now())
         
         if result.split()[1] == '0':
             await safe_answer_query(query, "ليس لديك صلاحية لإدارة هذا السحب!", show_alert=True)
             return
         
-        keyboard = [
-            [InlineKeyboardButton("المشاركة في السحب", callback_data=f'join_{roulette_id}')],
-            [
-                InlineKeyboardButton("🎲 ابدأ السحب", callback_data=f'draw_{roulette_id}'),
-                InlineKeyboardButton("⏸ إيقاف المشاركة" if new_status else "⏹ استأناف المشاركة", 
-                                   callback_data=f'stop_{roulette_id}')
-            ],
-            [InlineKeyboardButton("🔔 ذكرني إذا فزت 💌", callback_data='remind_me')]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        roulette_registry.invalidate(roulette_id)
+        reply_markup = roulette_post_markup(roulette_id, new_status)
+        edit_coalescer.set_markup(roulette_id, reply_markup)
         
         try:
             await context.bot.edit_message_reply_markup(
@@ -941,7 +2650,8 @@ async def stop_participation(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 [InlineKeyboardButton("🎲 ابدأ السحب", callback_data=f'draw_{roulette_id}')],
                 [InlineKeyboardButton("⏸ استئناف المشاركة" if new_status else "⏹ أوقف المشاركة", 
                                    callback_data=f'stop_{roulette_id}')],
-                [InlineKeyboardButton("👥 عرض المشاركين", callback_data=f'view_participants_{roulette_id}')]
+                [InlineKeyboardButton("👥 عرض المشاركين", callback_data=f'view_participants_{roulette_id}')],
+                [InlineKeyboardButton("📤 تصدير المشاركين", callback_data=f'export_participants_{roulette_id}')]
             ]
             
             await context.bot.send_message(
@@ -954,38 +2664,485 @@ async def stop_participation(update: Update, context: ContextTypes.DEFAULT_TYPE)
             logger.error(f"Error updating message buttons: {e}")
             await safe_answer_query(query, "تم تغيير الحالة ولكن حدث خطأ في تحديث الرسالة", show_alert=True)
 
+# السحوبات التي لها موعد أو حد أقصى ولم تُسحب بعد؛ due_at = NULL تعني أنها مستحقة الآن
+PENDING_TIMERS_SQL = """
+    SELECT id,
+           CASE WHEN auto_closed_at IS NULL
+                     AND (max_participants IS NULL OR participant_count < max_participants)
+                THEN closes_at END AS due_at
+    FROM roulettes
+    WHERE drawn_at IS NULL AND archived_at IS NULL
+      AND (closes_at IS NOT NULL OR max_participants IS NOT NULL)
+      AND (auto_closed_at IS NULL AND (closes_at IS NOT NULL OR participant_count >= max_participants)
+           OR auto_closed_at IS NOT NULL AND auto_draw)
+"""
+
+async def close_and_draw(application, pool, roulette_id: int) -> None:
+    """إغلاق السحب عند حلول موعده أو اكتمال عدده، ثم سحب الفائزين إن كان السحب التلقائي مفعلاً"""
+    roulette = await pool.fetchrow("""
+        UPDATE roulettes SET is_active = FALSE, auto_closed_at = now()
+        WHERE id = $1 AND drawn_at IS NULL AND auto_closed_at IS NULL AND archived_at IS NULL
+          AND (closes_at <= $2 OR participant_count >= max_participants)
+        RETURNING creator_id, chat_id, message_id, auto_draw
+    """, roulette_id, datetime.now())
+    
+    if roulette:
+        roulette_registry.invalidate(roulette_id)
+        reply_markup = roulette_post_markup(roulette_id, False)
+        edit_coalescer.set_markup(roulette_id, reply_markup)
+        try:
+            await application.bot.edit_message_reply_markup(
+                chat_id=roulette['chat_id'],
+                message_id=roulette['message_id'],
+                reply_markup=reply_markup
+            )
+        except Exception as e:
+            logger.error(f"Error updating buttons of auto-closed roulette {roulette_id}: {e}")
+    else:
+        # أُغلق سابقًا ولم يكتمل السحب (مثلاً توقفت العملية بينهما)
+        roulette = await pool.fetchrow("""
+            SELECT creator_id, auto_draw FROM roulettes
+            WHERE id = $1 AND drawn_at IS NULL AND auto_closed_at IS NOT NULL
+        """, roulette_id)
+    
+    if not roulette or not roulette['auto_draw']:
+        return
+    
+    status = await perform_draw(application, pool, roulette_id)
+    if status == 'ok':
+        await notification_sender.send(roulette['creator_id'], f"✅ تم سحب الفائزين تلقائيًا في السحب رقم {roulette_id}!")
+    elif status == 'not_enough':
+        await pool.execute("UPDATE roulettes SET auto_draw = FALSE WHERE id = $1", roulette_id)
+        await notification_sender.send(
+            roulette['creator_id'],
+            f"⛔ تم إغلاق السحب رقم {roulette_id} تلقائيًا، لكن عدد المشاركين أقل من عدد الفائزين.\n"
+            f"يمكنك استئناف المشاركة من أزرار إدارة السحب."
+        )
+
+class RouletteScheduler:
+    """مؤقت واحد لكل العملية للإغلاق والسحب التلقائي.
+
+    المواعيد في heap، ومهمة واحدة تنام حتى أقرب موعد وتستيقظ مبكرًا إذا أُضيف موعد أقرب.
+    تغيير موعد سحب يضيف مدخلاً جديدًا، والمداخل القديمة تُتخطى عند خروجها من الـ heap.
+    """
+
+    def __init__(self, concurrency: int):
+        self._heap = []
+        self._deadlines = {}
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._application = None
+        self._pool = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, roulette_id: int, when: datetime) -> None:
+        current = self._deadlines.get(roulette_id)
+        if current is not None and current <= when:
+            return
+        self._deadlines[roulette_id] = when
+        heapq.heappush(self._heap, (when, roulette_id))
+        if self._heap[0] == (when, roulette_id):
+            self._wakeup.set()
+
+    def trigger(self, roulette_id: int) -> None:
+        self.schedule(roulette_id, datetime.now())
+
+    async def start(self, application, pool) -> int:
+        """تحميل المواعيد المعلقة من قاعدة البيانات وتشغيل المؤقت"""
+        self._application = application
+        self._pool = pool
+        now = datetime.now()
+        rows = await pool.fetch(PENDING_TIMERS_SQL)
+        for row in rows:
+            self.schedule(row['id'], row['due_at'] or now)
+        self._task = asyncio.create_task(self._run())
+        return len(rows)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = datetime.now()
+            while self._heap and self._heap[0][0] <= now:
+                when, roulette_id = heapq.heappop(self._heap)
+                if self._deadlines.get(roulette_id) != when:
+                    continue
+                del self._deadlines[roulette_id]
+                self._application.create_task(self._fire(roulette_id))
+            
+            # النوم محدود حتى لا يتأخر المؤقت كثيرًا إذا تغيرت ساعة النظام
+            timeout = min((self._heap[0][0] - now).total_seconds(), 300) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, roulette_id: int) -> None:
+        async with self._semaphore:
+            try:
+                await close_and_draw(self._application, self._pool, roulette_id)
+            except Exception as e:
+                logger.error(f"Auto-close of roulette {roulette_id} failed, retrying later: {e}")
+                self.schedule(roulette_id, datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY))
+
+roulette_scheduler = RouletteScheduler(SCHEDULER_CONCURRENCY)
+
+# استعلامات صفحات المشاركين: صفحة ثابتة الحجم بترتيب (joined_at, id) مع التحقق من
+# صلاحية المنشئ وجلب العدد الكلي في نفس الاستعلام
+PARTICIPANTS_PAGE_SQL = """
+    SELECT r.participant_count, p.id, p.full_name, p.username, p.user_id
+    FROM roulettes r
+    LEFT JOIN LATERAL (
+        SELECT id, full_name, username, user_id, joined_at
+        FROM participants
+        WHERE roulette_id = r.id {condition}
+        ORDER BY joined_at {order}, id {order}
+        LIMIT $3
+    ) p ON TRUE
+    WHERE r.id = $1 AND r.creator_id = $2
+    ORDER BY p.joined_at, p.id
+"""
+PARTICIPANTS_CURSOR = "(SELECT joined_at, id FROM participants WHERE roulette_id = r.id AND id = $4)"
+PARTICIPANTS_FIRST_PAGE = PARTICIPANTS_PAGE_SQL.format(condition="", order="ASC")
+PARTICIPANTS_NEXT_PAGE = PARTICIPANTS_PAGE_SQL.format(
+    condition=f"AND (joined_at, id) > {PARTICIPANTS_CURSOR}", order="ASC")
+PARTICIPANTS_PREV_PAGE = PARTICIPANTS_PAGE_SQL.format(
+    condition=f"AND (joined_at, id) < {PARTICIPANTS_CURSOR}", order="DESC")
+
+async def fetch_participants_page(pool, roulette_id: int, creator_id: int, direction: str = None, cursor_id: int = None):
+    """يعيد (العدد الكلي، الصفوف، هل توجد صفحة أبعد في نفس الاتجاه) أو None إن لم يكن منشئ السحب"""
+    limit = PARTICIPANTS_PAGE_SIZE + 1
+    if direction == 'n':
+        rows = await pool.fetch(PARTICIPANTS_NEXT_PAGE, roulette_id, creator_id, limit, cursor_id)
+    elif direction == 'p':
+        rows = await pool.fetch(PARTICIPANTS_PREV_PAGE, roulette_id, creator_id, limit, cursor_id)
+    else:
+        rows = await pool.fetch(PARTICIPANTS_FIRST_PAGE, roulette_id, creator_id, limit)
+    
+    if not rows:
+        return None
+    
+    total = rows[0]['participant_count']
+    rows = [row for row in rows if row['id'] is not None]
+    has_more = len(rows) > PARTICIPANTS_PAGE_SIZE
+    if has_more:
+        # الصف الزائد يقع في طرف الاتجاه المطلوب
+        rows = rows[1:] if direction == 'p' else rows[:-1]
+    return total, rows, has_more
+
+def render_participants_page(roulette_id: int, page: int, total: int, rows, has_prev: bool, has_next: bool):
+    pages = max(1, -(-total // PARTICIPANTS_PAGE_SIZE))
+    lines = [
+        f"{page * PARTICIPANTS_PAGE_SIZE + i + 1}. {html.escape((p['full_name'] or '')[:64])} "
+        f"(@{html.escape(p['username'] or '-')}) - {p['user_id']}"
+        for i, p in enumerate(rows)
+    ]
+    text = (
+        f"قائمة المشاركين في السحب ({total} مشارك)\n"
+        f"الصفحة {page + 1} من {pages}\n\n" + "\n".join(lines)
+    )
+    
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            "◀️ السابق", callback_data=f"participants_page_{roulette_id}_{page - 1}_p_{rows[0]['id']}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            "التالي ▶️", callback_data=f"participants_page_{roulette_id}_{page + 1}_n_{rows[-1]['id']}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return text, reply_markup
+
+@instrumented
 async def view_participants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user = query.from_user
     roulette_id = int(query.data.split('_')[2])
     pool = context.bot_data.get('pool')
     
-    if not await safe_answer_query(query):
+    result = await fetch_participants_page(pool, roulette_id, user.id)
+    if result is None:
+        await safe_answer_query(query, "ليس لديك صلاحية لإدارة هذا السحب!", show_alert=True)
         return
     
-    async with pool.acquire() as conn:
-        participants = await conn.fetch("""
-            SELECT full_name, username, user_id 
-            FROM participants 
-            WHERE roulette_id = $1
-            ORDER BY joined_at
-        """, roulette_id)
-        
-        if not participants:
+    total, rows, has_next = result
+    if not rows:
+        if total:
+            await safe_answer_query(query, "تمت أرشفة مشاركي هذا السحب، استخدم زر التصدير للحصول عليهم.", show_alert=True)
+        else:
             await safe_answer_query(query, "لا يوجد مشاركون بعد!", show_alert=True)
-            return
-        
-        participants_text = "\n".join(
-            [f"{i+1}. {p['full_name']} (@{p['username']}) - {p['user_id']}" 
-             for i, p in enumerate(participants)]
-        )
-        
-        await context.bot.send_message(
-            chat_id=user.id,
-            text=f"قائمة المشاركين في السحب:\n\n{participants_text}",
+        return
+    
+    await safe_answer_query(query)
+    text, reply_markup = render_participants_page(roulette_id, 0, total, rows, False, has_next)
+    await context.bot.send_message(
+        chat_id=user.id,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.HTML
+    )
+
+@instrumented
+async def participants_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """التنقل بين صفحات المشاركين بتعديل نفس الرسالة"""
+    query = update.callback_query
+    user = query.from_user
+    _, _, roulette_id, page, direction, cursor_id = query.data.split('_')
+    roulette_id, page, cursor_id = int(roulette_id), int(page), int(cursor_id)
+    pool = context.bot_data.get('pool')
+    
+    result = await fetch_participants_page(pool, roulette_id, user.id, direction, cursor_id)
+    if result is None:
+        await safe_answer_query(query, "ليس لديك صلاحية لإدارة هذا السحب!", show_alert=True)
+        return
+    
+    total, rows, has_more = result
+    if not rows:
+        await safe_answer_query(query, "لا يوجد مشاركون في هذه الصفحة", show_alert=True)
+        return
+    
+    if direction == 'p':
+        has_prev, has_next = has_more and page > 0, True
+    else:
+        has_prev, has_next = page > 0, has_more
+    
+    await safe_answer_query(query)
+    text, reply_markup = render_participants_page(roulette_id, page, total, rows, has_prev, has_next)
+    try:
+        await query.edit_message_text(
+            text=text,
+            reply_markup=reply_markup,
             parse_mode=ParseMode.HTML
         )
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+
+async def ensure_participant_partition(conn, roulette_id: int) -> None:
+    """إنشاء جزء جدول المشاركين لهذا السحب والجزء التالي إن لم يكونا موجودين.
+
+    لا يُستدعى داخل نفس الاستعلام الذي يضيف السحب، لأن إنشاء الجزء يضيف قيد المفتاح
+    الأجنبي على roulettes.
+    """
+    await conn.execute("""
+        SELECT participants_ensure_partition($1), participants_ensure_partition($1 + participants_partition_size())
+    """, roulette_id)
+
+async def archive_roulette_participants(pool, roulette_id: int) -> int:
+    """نقل مشاركي سحب منتهٍ أو مهجور إلى participants_archive كـ gzip JSONL ← عدد المشاركين أو -1 إن تخطيناه.
+
+    النسخ وحذف الصفوف من participants وإغلاق السحب في معاملة واحدة.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # SKIP LOCKED حتى لا تؤرشف نسختان من البوت نفس السحب
+            locked = await conn.fetchval("""
+                SELECT id FROM roulettes WHERE id = $1 AND archived_at IS NULL
+                FOR UPDATE SKIP LOCKED
+            """, roulette_id)
+            if not locked:
+                return -1
+            
+            buffer = io.BytesIO()
+            count = 0
+            first_joined_at = last_joined_at = None
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed:
+                async for row in conn.cursor("""
+                    SELECT user_id, username, full_name, joined_at FROM participants
+                    WHERE roulette_id = $1
+                    ORDER BY joined_at, id
+                """, roulette_id, prefetch=DRAW_FETCH_SIZE):
+                    joined_at = row['joined_at']
+                    compressed.write(json.dumps({
+                        'user_id': row['user_id'],
+                        'username': row['username'],
+                        'full_name': row['full_name'],
+                        'joined_at': joined_at.isoformat(sep=' ') if joined_at else None,
+                    }, ensure_ascii=False).encode() + b'\n')
+                    count += 1
+                    first_joined_at = first_joined_at or joined_at
+                    last_joined_at = joined_at or last_joined_at
+            
+            await conn.execute("""
+                INSERT INTO participants_archive (roulette_id, participant_count, first_joined_at, last_joined_at, data)
+                VALUES ($1, $2, $3, $4, $5)
+            """, roulette_id, count, first_joined_at, last_joined_at, buffer.getvalue())
+            await conn.execute("DELETE FROM participants WHERE roulette_id = $1", roulette_id)
+            await conn.execute("""
+                UPDATE roulettes SET is_active = FALSE, archived_at = now() WHERE id = $1
+            """, roulette_id)
+    roulette_registry.invalidate(roulette_id)
+    participant_filter.discard(roulette_id)
+    return count
+
+async def drop_archived_partitions(pool) -> int:
+    """فصل وحذف أجزاء المشاركين التي أُرشفت كل سحوباتها (صارت فارغة)؛ الجزء الحالي لا يُحذف أبدًا"""
+    partitions = await pool.fetch("""
+        SELECT c.relname AS name, (regexp_match(c.relname, '^participants_p(\\d+)$'))[1]::integer AS start_id
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'participants'::regclass
+    """)
+    current_start = await pool.fetchval("""
+        SELECT COALESCE(max(id), 0) / participants_partition_size() * participants_partition_size() FROM roulettes
+    """)
+    
+    dropped = 0
+    for partition in sorted(partitions, key=lambda p: p['start_id'] if p['start_id'] is not None else -1):
+        start_id = partition['start_id']
+        if start_id is None or start_id >= current_start:
+            continue
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # الفصل يحتاج قفلاً قصيرًا على الجدول الأب؛ لا ننتظره طويلاً حتى لا تتعطل المشاركات
+                await conn.execute("SET LOCAL lock_timeout = '2s'")
+                pending = await conn.fetchval("""
+                    SELECT EXISTS (
+                        SELECT 1 FROM roulettes
+                        WHERE id >= $1 AND id < $1 + participants_partition_size() AND archived_at IS NULL
+                    )
+                """, start_id)
+                if pending:
+                    continue
+                # الاسم من pg_class وتحقق منه التعبير النمطي أعلاه
+                await conn.execute(f'ALTER TABLE participants DETACH PARTITION "{partition["name"]}"')
+                await conn.execute(f'DROP TABLE "{partition["name"]}"')
+        dropped += 1
+    return dropped
+
+async def archive_participants(pool) -> dict:
+    """مهمة دورية: نقل مشاركي السحوبات المنتهية منذ ARCHIVE_AFTER_DAYS يومًا، والسحوبات التي لم تُسحب
+    ولم يشارك فيها أحد منذ ARCHIVE_IDLE_DAYS يومًا (تُغلق)، إلى الأرشيف، ثم حذف الأجزاء الفارغة"""
+    started_at = datetime.now()
+    result = {'roulettes': 0, 'participants': 0, 'partitions_dropped': 0}
+    error = None
+    try:
+        await ensure_participant_partition(pool, await pool.fetchval("SELECT COALESCE(max(id), 0) FROM roulettes"))
+        candidates = await pool.fetch("""
+            SELECT id FROM roulettes r
+            WHERE archived_at IS NULL
+              AND (COALESCE(drawn_at, auto_closed_at) < $1
+                   OR drawn_at IS NULL
+                      AND GREATEST(created_at, (SELECT max(joined_at) FROM participants p
+                                                WHERE p.roulette_id = r.id)) < $2)
+            ORDER BY id
+            LIMIT $3
+        """, started_at - timedelta(days=ARCHIVE_AFTER_DAYS), started_at - timedelta(days=ARCHIVE_IDLE_DAYS),
+            ARCHIVE_BATCH)
+        for candidate in candidates:
+            count = await archive_roulette_participants(pool, candidate['id'])
+            if count >= 0:
+                result['roulettes'] += 1
+                result['participants'] += count
+        result['partitions_dropped'] = await drop_archived_partitions(pool)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        await record_job_run(pool, 'archive_participants', started_at, result['participants'], result, error)
+    if result['roulettes'] or result['partitions_dropped']:
+        logger.info(f"archive_participants: {result}")
+    return result
+
+def write_archive_csv(data: bytes, fileobj) -> int:
+    """تحويل نسخة الأرشيف (gzip JSONL) إلى نفس صيغة CSV التي يصدرها COPY ← عدد الصفوف"""
+    text = io.TextIOWrapper(fileobj, encoding='utf-8', newline='')
+    writer = csv.writer(text, lineterminator='\n')
+    writer.writerow(['user_id', 'username', 'full_name', 'joined_at'])
+    rows = 0
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as archive:
+        for line in archive:
+            row = json.loads(line)
+            writer.writerow([row['user_id'], row['username'], row['full_name'], row['joined_at']])
+            rows += 1
+    text.flush()
+    text.detach()
+    return rows
+
+export_semaphore = asyncio.Semaphore(EXPORT_CONCURRENCY)
+
+async def send_participants_export(bot, pool, roulette_id: int, chat_id: int) -> None:
+    """تصدير المشاركين إلى ملف CSV مضغوط وإرساله كمستند.
+
+    الصفوف تُنقل من Postgres عبر COPY مباشرة إلى ملف مؤقت مضغوط على القرص
+    (الكتابة والضغط في خيوط asyncpg الخلفية)، فبناء الملف لا يحمّل الصفوف في الذاكرة.
+    COPY يعمل على اتصال مستقل بلا مهلة (unbounded_connection) حتى لا يُلغى التصدير الكبير.
+    لكن الرفع يمر بـ InputFile في PTB الذي يقرأ الملف المضغوط كاملاً في الذاكرة، ونسخة
+    الأرشيف (BYTEA) تُجلب كاملة أيضًا؛ لذلك الحد الفعلي لكل تصدير هو حجم الملف المضغوط
+    (حتى MAX_DOCUMENT_SIZE) مضافًا إليه حجم نسخة الأرشيف إن وجدت، مضروبًا في EXPORT_CONCURRENCY.
+    طلبات التصدير المتكررة لنفس السحب لا تُدمج؛ كل طلب يبني ملفه ويرسله.
+    """
+    async with export_semaphore:
+        try:
+            archived = await pool.fetchval("SELECT data FROM participants_archive WHERE roulette_id = $1", roulette_id)
+            with tempfile.TemporaryFile() as raw:
+                with gzip.GzipFile(filename=f"roulette_{roulette_id}_participants.csv", mode='wb', fileobj=raw) as compressed:
+                    if archived is not None:
+                        rows = await asyncio.to_thread(write_archive_csv, archived, compressed)
+                    else:
+                        async with pool.unbounded_connection() as conn:
+                            status = await conn.copy_from_query("""
+                                SELECT user_id, username, full_name, joined_at
+                                FROM participants
+                                WHERE roulette_id = $1
+                                ORDER BY joined_at, id
+                            """, roulette_id, output=compressed, format='csv', header=True)
+                        rows = int(status.split()[-1])
+                
+                size = raw.tell()
+                if size > MAX_DOCUMENT_SIZE:
+                    await bot.send_message(chat_id=chat_id, text="❌ ملف المشاركين أكبر من الحد المسموح به في تليجرام.")
+                    return
+                
+                raw.seek(0)
+                await bot.send_document(
+                    chat_id=chat_id,
+                    document=raw,
+                    filename=f"roulette_{roulette_id}_participants.csv.gz",
+                    caption=f"📤 المشاركون في السحب رقم {roulette_id}: {rows} مشارك"
+                )
+        except Exception as e:
+            logger.error(f"Error exporting participants of roulette {roulette_id}: {e}")
+            await bot.send_message(chat_id=chat_id, text="❌ حدث خطأ أثناء تصدير المشاركين. حاول لاحقًا!")
+
+@instrumented
+async def export_participants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user = query.from_user
+    roulette_id = int(query.data.split('_')[2])
+    pool = context.bot_data.get('pool')
+    
+    participant_count = await pool.fetchval("""
+        SELECT participant_count FROM roulettes
+        WHERE id = $1 AND creator_id = $2
+    """, roulette_id, user.id)
+    
+    if participant_count is None:
+        await safe_answer_query(query, "ليس لديك صلاحية لإدارة هذا السحب!", show_alert=True)
+        return
+    
+    if not participant_count:
+        await safe_answer_query(query, "لا يوجد مشاركون بعد!", show_alert=True)
+        return
+    
+    await safe_answer_query(query, "⏳ جاري تجهيز ملف المشاركين وسيصلك خلال لحظات")
+    # التصدير يعمل في الخلفية حتى لا يعطل بقية المعالجات
+    context.application.create_task(
+        send_participants_export(context.bot, pool, roulette_id, user.id),
+        update=update
+    )
 
+@instrumented
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = query.from_user.id
@@ -999,10 +3156,12 @@ async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     return MAIN_MENU
 
+@instrumented
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await show_admin_menu(update, context)
     return ADMIN_MENU
 
+@instrumented
 async def show_donate_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
@@ -1028,6 +3187,7 @@ async def show_donate_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         reply_markup=reply_markup
     )
 
+@instrumented
 async def handle_donate_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     amount = PRICES['donate']
@@ -1048,6 +3208,7 @@ async def handle_donate_selection(update: Update, context: ContextTypes.DEFAULT_
         logger.error(f"Error sending invoice: {e}")
         await safe_answer_query(query, "حدث خطأ أثناء إعداد عملية الدفع. يرجى المحاولة لاحقًا.", show_alert=True)
 
+@instrumented
 async def handle_pre_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.pre_checkout_query
     try:
@@ -1055,25 +3216,52 @@ async def handle_pre_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE
     except Exception as e:
         logger.error(f"Error in pre-checkout: {e}")
 
+# تسجيل التبرع وإضافة النجوم في معاملة واحدة؛ معرف الدفعة الفريد يمنع احتساب
+# نفس الدفعة مرتين إذا أعاد تليجرام إرسال التحديث (لا يُرجع صفًا في هذه الحالة)
+RECORD_DONATION_SQL = """
+    WITH recorded AS (
+        INSERT INTO donations (donor_id, amount, telegram_charge_id)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (telegram_charge_id) DO NOTHING
+        RETURNING donor_id, amount
+    )
+    INSERT INTO users (telegram_id, stars)
+    SELECT donor_id, amount FROM recorded
+    ON CONFLICT (telegram_id) DO UPDATE SET stars = users.stars + EXCLUDED.stars
+    RETURNING stars
+"""
+
+async def notify_admins(text: str, **kwargs) -> None:
+    """إرسال رسالة لكل المشرفين عبر طابور الإرسال في الخلفية"""
+    futures = [await notification_sender.send(admin_id, text, **kwargs) for admin_id in ADMINS]
+    for admin_id, error in zip(ADMINS, await asyncio.gather(*futures)):
+        if error:
+            logger.error(f"Failed to notify admin {admin_id}: {error}")
+
+@instrumented
 async def handle_successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     payment = update.message.successful_payment
     user = update.message.from_user
     amount = payment.total_amount
     pool = context.bot_data.get('pool')
     
+    credited = True
     if pool:
-        async with pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO donations (donor_id, amount)
-                VALUES ($1, $2)
-            """, user.id, amount)
-            
-            await conn.execute("""
-                UPDATE users 
-                SET stars = stars + $1 
-                WHERE telegram_id = $2
-            """, amount, user.id)
+        balance = await pool.fetchval(RECORD_DONATION_SQL, user.id, amount, payment.telegram_payment_charge_id)
+        credited = balance is not None
+        if credited:
+            user_cache.invalidate(user.id)
+        else:
+            logger.info(f"Duplicate successful_payment {payment.telegram_payment_charge_id} from {user.id} ignored")
     
+    await update.message.reply_text(
+        "✅ تم قبول الدفع بنجاح! شكراً لدعمك.\n"
+        "سيتم استخدام هذه الأموال لتحسين البوت وتقديم المزيد من الميزات."
+    )
+
+    if not credited:
+        return
+
     donation_details = (
         f"🎉 تم التبرع! \n\n"
         f"👤 الاسم: {user.full_name}\n"
@@ -1086,21 +3274,9 @@ async def handle_successful_payment(update: Update, context: ContextTypes.DEFAUL
     keyboard = [[InlineKeyboardButton("التحدث مع المتبرع", url=f"tg://user?id={user.id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    for admin_id in ADMINS:
-        try:
-            await context.bot.send_message(
-                admin_id,
-                donation_details,
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify admin {admin_id}: {e}")
-    
-    await update.message.reply_text(
-        "✅ تم قبول الدفع بنجاح! شكراً لدعمك.\n"
-        "سيتم استخدام هذه الأموال لتحسين البوت وتقديم المزيد من الميزات."
-    )
+    context.application.create_task(notify_admins(donation_details, reply_markup=reply_markup), update=update)
 
+@instrumented
 async def unlink_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1108,24 +3284,27 @@ async def unlink_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     async with pool.acquire() as conn:
         user_status = await check_user_payment_status(user_id, pool)
-        if not user_status['linked_channel']:
+        if not user_status['linked_channel_id']:
             await safe_answer_query(query, "لا يوجد قناة مربوطة!", show_alert=True)
             return MAIN_MENU
         
         await conn.execute("""
             UPDATE users 
-            SET linked_channel = NULL 
+            SET linked_channel_id = NULL, linked_channel_username = NULL, linked_channel_title = NULL
             WHERE telegram_id = $1
         """, user_id)
+    user_cache.invalidate(user_id)
     
     await safe_answer_query(query, "تم فصل القناة بنجاح", show_alert=True)
     await show_main_menu(update, context)
     return MAIN_MENU
 
+@instrumented
 async def remind_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await safe_answer_query(query, "سيتم إعلامك إذا فزت بأي سحب مستقبلي", show_alert=True)
 
+@instrumented
 async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await safe_answer_query(query)
@@ -1138,6 +3317,7 @@ async def support(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@instrumented
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -1169,102 +3349,388 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     elif update.message:
         await update.message.reply_text("حدث خطأ غير متوقع. يرجى المحاولة مرة أخرى!")
 
+async def serve_http(host: str, port: int, handle_request):
+    """خادم HTTP/1.1 مصغر فوق asyncio بدون اعتماديات إضافية.
+
+    handle_request(method, path, headers, body) تعيد (status, content_type, payload).
+    """
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > HTTP_MAX_BODY:
+                    status, content_type, payload = 413, 'text/plain', b''
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, content_type, payload = await handle_request(method, target.split('?')[0], headers, body)
+                    except Exception as e:
+                        logger.error(f"Error handling HTTP request {method} {target}: {e}")
+                        status, content_type, payload = 500, 'text/plain', b''
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError, ValueError):
+            # اتصال خامل أو مغلق أو إيقاف الخادم
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+def make_webhook_handler(application: Application, secret_token: str):
+    """استقبال تحديثات تليجرام: التحقق من الرمز السري ثم الرد فورًا ووضع التحديث في طابور المعالجة.
+    الرمز إلزامي، فبدونه يستطيع أي أحد يصل للمنفذ إرسال تحديثات مزيفة (مثل أزرار المشرفين)"""
+    async def handle(method, path, headers, body):
+        if path != WEBHOOK_PATH:
+            return 404, 'text/plain', b''
+        if method != 'POST':
+            return 405, 'text/plain', b''
+        if not hmac.compare_digest(
+                headers.get('x-telegram-bot-api-secret-token', '').encode(), secret_token.encode()):
+            return 403, 'text/plain', b''
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            return 400, 'text/plain', b''
+
+        try:
+            application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # تليجرام يعيد إرسال التحديث لاحقًا
+            return 503, 'text/plain', b''
+        return 200, 'text/plain', b'ok'
+
+    return handle
+
+async def start_webhook(application: Application):
+    server = await serve_http(WEBHOOK_LISTEN, WEBHOOK_PORT, make_webhook_handler(application, WEBHOOK_SECRET))
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+    else:
+        logger.warning("WEBHOOK_URL is not set, the webhook was not registered with Telegram")
+    return server
+
+metrics.register_callback(
+    'bot_cache_lookups_total', 'In-process cache lookups', 'counter', ['cache', 'result'],
+    lambda: [
+        (('membership', 'hit'), membership_cache.hits),
+        (('membership', 'miss'), membership_cache.misses),
+        (('user_profile', 'hit'), user_cache.hits),
+        (('user_profile', 'miss'), user_cache.misses),
+        (('roulette', 'hit'), roulette_registry.hits),
+        (('roulette', 'miss'), roulette_registry.misses),
+        (('participants', 'hit'), participant_filter.hits),
+        (('participants', 'miss'), participant_filter.misses),
+    ])
+metrics.register_callback(
+    'bot_scheduled_roulettes', 'Roulettes waiting for an auto-close or auto-draw timer', 'gauge', [],
+    lambda: [((), len(roulette_scheduler))])
+metrics.register_callback(
+    'bot_throttle_buckets', 'Token buckets held by the callback throttle', 'gauge', ['scope'],
+    lambda: [(('user',), len(user_throttle)), (('roulette',), len(roulette_throttle))])
+metrics.register_callback(
+    'bot_participant_filter_bytes', 'Memory held by the duplicate-join filter', 'gauge', [],
+    lambda: [((), participant_filter.nbytes)])
+metrics.register_callback(
+    'bot_participant_filter_roulettes', 'Roulettes loaded in the duplicate-join filter', 'gauge', [],
+    lambda: [((), len(participant_filter))])
+metrics.register_callback(
+    'bot_update_locks', 'Per-user and per-roulette update locks currently held or awaited', 'gauge', [],
+    lambda: [((), len(update_locks))])
+metrics.register_callback(
+    'bot_notification_queue_size', 'Messages waiting in the background sender queue', 'gauge', [],
+    lambda: [((), notification_sender._queue.qsize())])
+
+async def start_metrics_server():
+    async def handle(method, path, headers, body):
+        if path != '/metrics':
+            return 404, 'text/plain', b''
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+
+    server = await serve_http(METRICS_LISTEN, METRICS_PORT, handle)
+    logger.info(f"Metrics available at http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+class KeyedLocks:
+    """أقفال asyncio حسب المفتاح، تُنشأ عند الطلب وتُحذف عندما لا ينتظرها أحد"""
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        # ترتيب ثابت للمفاتيح يمنع الجمود بين تحديثين يحتاجان نفس القفلين
+        keys = sorted(set(keys))
+        entries = []
+        for key in keys:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            entries.append((key, entry))
+        acquired = []
+        try:
+            for _, entry in entries:
+                await entry[0].acquire()
+                acquired.append(entry[0])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            for key, entry in entries:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+update_locks = KeyedLocks()
+# أماكن المعالجة تؤخذ بعد القفل، فالتحديثات المنتظرة خلف مستخدم أو سحب مشغول لا تحجزها
+update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+# التحديثات التي سُحبت من الطابور ولم تنته بعد (الضغط العكسي على سحب التحديثات)
+update_pending = asyncio.Semaphore(UPDATE_MAX_PENDING)
+
+_ROULETTE_MUTATION = re.compile(r'^(?:draw|stop)_(\d+)$')
+
+def update_lock_keys(update) -> list:
+    """مفاتيح الأقفال للتحديث: المستخدم دائمًا (حالة المحادثة وبياناته)، والسحب لأزرار
+    السحب والإيقاف. المشاركة لا تقفل السحب لأن استعلامها ذري، حتى لا تتسلسل المشاركات"""
+    if not isinstance(update, Update):
+        return []
+    keys = []
+    if update.effective_user:
+        keys.append(('user', update.effective_user.id))
+    if update.callback_query and update.callback_query.data:
+        match = _ROULETTE_MUTATION.match(update.callback_query.data)
+        if match:
+            keys.append(('roulette', int(match.group(1))))
+    return keys
+
+class KeyedApplication(Application):
+    """معالجة التحديثات بالتوازي مع تسلسل التحديثات التي تعدل نفس المستخدم أو نفس السحب.
+
+    _update_fetcher في PTB 20.0 ينشئ مهمة لكل تحديث دون انتظار ويأخذ حد التوازي داخلها
+    قبل process_update، فالمنتظرون خلف قفل يحجزون أماكن المعالجة والمهام لا حد لها. لذلك
+    نستبدله: يأخذ مكانًا من update_pending قبل سحب كل تحديث (ضغط عكسي حقيقي)، والمعالجة
+    تأخذ update_slots بعد قفل المفاتيح، فضغطات مستخدم واحد أو سحب مزدحم تنتظر في طابور
+    مفتاحها دون أن تمنع باقي المحادثات.
+    """
+
+    async def _update_fetcher(self) -> None:
+        # مطابق لـ Application._update_fetcher في PTB 20.0 عدا الحد قبل سحب التحديث
+        while True:
+            await update_pending.acquire()
+            update = await self.update_queue.get()
+
+            if update is _STOP_SIGNAL:
+                update_pending.release()
+                while not self.update_queue.empty():
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+
+            self.create_task(self._process_pending_update(update), update=update)
+
+    async def _process_pending_update(self, update: object) -> None:
+        try:
+            await self.process_update(update)
+        finally:
+            self.update_queue.task_done()
+            update_pending.release()
+
+    async def process_update(self, update: object) -> None:
+        if await reject_throttled(update):
+            return None
+        async with update_locks.hold(*update_lock_keys(update)):
+            async with update_slots:
+                return await super().process_update(update)
+
+def build_application(token: str, pool, base_url: str = None) -> Application:
+    """إنشاء التطبيق وتسجيل كل المعالجات (مشترك بين وضعي polling و webhook واختبارات الحمل)"""
+    builder = (
+        Application.builder()
+        .application_class(KeyedApplication)
+        .token(token)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_MAX_PENDING))
+        .request(InstrumentedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+        .rate_limiter(TelegramRateLimiter(
+            TELEGRAM_GLOBAL_RATE, TELEGRAM_PRIVATE_CHAT_RATE, TELEGRAM_GROUP_CHAT_RATE, TELEGRAM_CHAT_BURST,
+            TELEGRAM_BULK_RESERVE, TELEGRAM_MAX_RETRIES, TELEGRAM_MAX_RETRY_WAIT))
+        .get_updates_request(InstrumentedRequest())
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.bot_data['pool'] = pool
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('start', start)],
+        states={
+            START: [
+                CallbackQueryHandler(subscribed, pattern='^subscribed$')
+            ],
+            MAIN_MENU: [
+                CallbackQueryHandler(create_roulette, pattern='^create_roulette$'),
+                CallbackQueryHandler(link_channel, pattern='^link_channel$'),
+                CallbackQueryHandler(unlink_channel, pattern='^unlink_channel$'),
+                CallbackQueryHandler(show_donate_menu, pattern='^donate_menu$'),
+                CallbackQueryHandler(remind_me, pattern='^remind_me$'),
+                CallbackQueryHandler(support, pattern='^support$'),
+                CallbackQueryHandler(balance, pattern='^balance$'),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
+            ],
+            ADMIN_MENU: [
+                CallbackQueryHandler(admin_add_points, pattern='^add_points$'),
+                CallbackQueryHandler(admin_menu, pattern='^admin_menu$'),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, admin_handle_points)
+            ],
+            WAITING_FOR_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_roulette_text),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
+            ],
+            ADD_CHANNEL: [
+                CallbackQueryHandler(add_channel, pattern='^add_channel$'),
+                CallbackQueryHandler(skip_channel, pattern='^skip_channel$'),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
+            ],
+            PAYMENT: [
+                CallbackQueryHandler(handle_payment, pattern='^(upgrade_month|upgrade_once|upgrade_month_points|upgrade_once_points)$'),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
+            ],
+            WAITING_FOR_WINNERS: [
+                CallbackQueryHandler(set_winners, pattern=r'^winners_\d+$'),
+                CallbackQueryHandler(set_auto_close, pattern=r'^autoclose_(t_\d+|c_\d+|none)$'),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link_channel)
+            ],
+            LINK_CHANNEL: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link_channel),
+                CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
+            ]
+        },
+        fallbacks=[CommandHandler('start', start)],
+        per_message=False
+    )
+
+    application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(join_roulette, pattern='^join_'))
+    application.add_handler(CallbackQueryHandler(draw_roulette, pattern='^draw_'))
+    application.add_handler(CallbackQueryHandler(stop_participation, pattern='^stop_'))
+    application.add_handler(CallbackQueryHandler(view_participants, pattern='^view_participants_'))
+    application.add_handler(CallbackQueryHandler(participants_page, pattern=r'^participants_page_\d+_\d+_[np]_\d+$'))
+    application.add_handler(CallbackQueryHandler(export_participants, pattern=r'^export_participants_\d+$'))
+    application.add_handler(CallbackQueryHandler(back_to_main, pattern='^back_to_main$'))
+    application.add_handler(CallbackQueryHandler(handle_donate_selection, pattern='^donate$'))
+    application.add_handler(CallbackQueryHandler(admin_menu, pattern='^admin_menu$'))
+    application.add_handler(PreCheckoutQueryHandler(handle_pre_checkout))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, handle_successful_payment))
+    application.add_error_handler(error_handler)
+    return application
+
 async def main() -> None:
     TOKEN = os.getenv('BOT_TOKEN')
     
-    # التحقق من التوكن قبل البدء
     if not TOKEN:
         logger.error("لم يتم تعيين BOT_TOKEN في متغيرات البيئة!")
         return
-    
-    if not await verify_token(TOKEN):
-        logger.error("توكن البوت غير صالح أو مرفوض من قبل سيرفر تليجرام!")
+
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        logger.error("وضع webhook يحتاج WEBHOOK_SECRET أو WEBHOOK_URL (لتوليد رمز سري)؛ لن يبدأ الخادم بدون رمز")
         return
 
     if platform.system() == 'Windows':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
-    pool = await init_db()
-    
-    # التحقق من نجاح تهيئة الاتصال بقاعدة البيانات
+    started = time.perf_counter()
+    timings = {}
 
-    if not pool:
-        logger.error("فشل تهيئة اتصال قاعدة البيانات!")
+    async def timed(phase, coro):
+        phase_started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[phase] = time.perf_counter() - phase_started
+
+    # application.initialize يستدعي getMe فيتحقق من التوكن، ويعمل بالتوازي مع تهيئة قاعدة البيانات
+    application = build_application(TOKEN, None)
+    pool, initialized = await asyncio.gather(
+        timed('database', init_db()),
+        timed('telegram', application.initialize()),
+        return_exceptions=True
+    )
+    
+    if isinstance(initialized, BaseException) or isinstance(pool, BaseException) or not pool:
+        if isinstance(initialized, BaseException):
+            logger.error(f"توكن البوت غير صالح أو تعذر الاتصال بتليجرام: {initialized}")
+        else:
+            await application.shutdown()
+        if isinstance(pool, BaseException) or not pool:
+            logger.error("فشل تهيئة اتصال قاعدة البيانات!")
+        else:
+            await pool.close()
         return
 
+    application.bot_data['pool'] = pool
+    webhook_server = None
+    metrics_server = None
+    background_jobs = []
     try:
-        application = Application.builder().token(TOKEN).build()
-        application.bot_data['pool'] = pool
-
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('start', start)],
-            states={
-                START: [
-                    CallbackQueryHandler(subscribed, pattern='^subscribed$')
-                ],
-                MAIN_MENU: [
-                    CallbackQueryHandler(create_roulette, pattern='^create_roulette$'),
-                    CallbackQueryHandler(link_channel, pattern='^link_channel$'),
-                    CallbackQueryHandler(unlink_channel, pattern='^unlink_channel$'),
-                    CallbackQueryHandler(show_donate_menu, pattern='^donate_menu$'),
-                    CallbackQueryHandler(remind_me, pattern='^remind_me$'),
-                    CallbackQueryHandler(support, pattern='^support$'),
-                    CallbackQueryHandler(balance, pattern='^balance$'),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
-                ],
-                ADMIN_MENU: [
-                    CallbackQueryHandler(admin_add_points, pattern='^add_points$'),
-                    CallbackQueryHandler(admin_menu, pattern='^admin_menu$'),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, admin_handle_points)
-                ],
-                WAITING_FOR_TEXT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_roulette_text),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
-                ],
-                ADD_CHANNEL: [
-                    CallbackQueryHandler(add_channel, pattern='^add_channel$'),
-                    CallbackQueryHandler(skip_channel, pattern='^skip_channel$'),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
-                ],
-                PAYMENT: [
-                    CallbackQueryHandler(handle_payment, pattern='^(upgrade_month|upgrade_once|upgrade_month_points|upgrade_once_points)$'),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
-                    MessageHandler(filters.SUCCESSFUL_PAYMENT, handle_successful_payment)
-                ],
-                WAITING_FOR_WINNERS: [
-                    CallbackQueryHandler(set_winners, pattern=r'^winners_\d+$'),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$'),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link_channel)
-                ],
-                LINK_CHANNEL: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_link_channel),
-                    CallbackQueryHandler(back_to_main, pattern='^back_to_main$')
-                ]
-            },
-            fallbacks=[CommandHandler('start', start)],
-            per_message=False
-        )
-
-        application.add_handler(conv_handler)
-        application.add_handler(CallbackQueryHandler(join_roulette, pattern='^join_'))
-        application.add_handler(CallbackQueryHandler(draw_roulette, pattern='^draw_'))
-        application.add_handler(CallbackQueryHandler(stop_participation, pattern='^stop_'))
-        application.add_handler(CallbackQueryHandler(view_participants, pattern='^view_participants_'))
-        application.add_handler(CallbackQueryHandler(back_to_main, pattern='^back_to_main$'))
-        application.add_handler(CallbackQueryHandler(handle_donate_selection, pattern='^donate$'))
-        application.add_handler(CallbackQueryHandler(admin_menu, pattern='^admin_menu$'))
-        application.add_handler(PreCheckoutQueryHandler(handle_pre_checkout))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, handle_successful_payment))
-        application.add_error_handler(error_handler)
-
-        await application.initialize()
         await application.start()
+        notification_sender.start(application.bot)
         
-        bot = await application.bot.get_me()
-        logger.info(f"Bot @{bot.username} started successfully!")
+        if BOT_MODE == 'webhook':
+            webhook_server = await timed('updates', start_webhook(application))
+        else:
+            await timed('updates', application.updater.start_polling(drop_pending_updates=True))
         
-        await application.updater.start_polling(drop_pending_updates=True)
+        logger.info(
+            f"Bot @{application.bot.username} started in {time.perf_counter() - started:.2f}s "
+            f"({', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in timings.items())})"
+        )
+
+        # المهام الخلفية تبدأ بعد استقبال التحديثات حتى لا تؤخر أول رد
+        background_jobs = [
+            asyncio.create_task(run_periodic(expire_premiums, pool, PREMIUM_SWEEP_INTERVAL)),
+            asyncio.create_task(run_periodic(archive_participants, pool, ARCHIVE_INTERVAL)),
+        ]
+        pending = await roulette_scheduler.start(application, pool)
+        logger.info(f"Loaded {pending} pending auto-close timers")
+        if METRICS_PORT:
+            metrics_server = await start_metrics_server()
 
         # البقاء في حلقة التشغيل
         while True:
@@ -1273,6 +3739,14 @@ async def main() -> None:
     except Exception as e:
         logger.error(f"فشل تشغيل البوت: {e}")
     finally:
+        if webhook_server:
+            webhook_server.close()
+        if metrics_server:
+            metrics_server.close()
+        for job in background_jobs:
+            job.cancel()
+        await roulette_scheduler.stop()
+        await notification_sender.stop()
         if pool:
             await pool.close()
 